@@ -0,0 +1,148 @@
+"""Harness of the API benchmarks.
+
+Every scenario runs in a fresh process, so its peak RSS is its own and one scenario cannot warm
+caches for another. Requests are sent by `concurrency` tasks through an in-process ASGI transport.
+Results are printed as a table and stored as JSON, pass an older file to --compare to see the change.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+async def drive(request, total: int, concurrency: int) -> tuple[list[float], int, float]:
+    """Calls request(i) for i in range(total) from concurrency tasks.
+    request returns whether the response was the expected one. Returns latencies, errors and wall time."""
+    latencies = []
+    errors = 0
+    indexes = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for index in indexes:
+            started = time.perf_counter()
+            try:
+                ok = await request(index)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+async def measure(module, name: str, total: int, concurrency: int) -> dict:
+    async with module.make_client() as client:
+        request = await module.SCENARIOS[name](client, total)
+        await drive(request, min(total, concurrency * 2), concurrency)  # warm up
+        latencies, errors, wall = await drive(request, total, concurrency)
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": total / wall if wall else 0.0,
+        "mean_ms": sum(latencies) / len(latencies) * 1e3 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1e3,
+        "p95_ms": percentile(latencies, 95) * 1e3,
+        "p99_ms": percentile(latencies, 99) * 1e3,
+        "max_ms": latencies[-1] * 1e3 if latencies else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_scenario(module_name: str, name: str, total: int, concurrency: int, rtt: float) -> dict:
+    """Entry point of the scenario process."""
+    module = importlib.import_module(module_name)
+    module.prepare(rtt)
+    return asyncio.run(measure(module, name, total, concurrency))
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results: list[dict], baseline: dict | None = None):
+    columns = ["scenario", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb", "errors"]
+    header = "".join(f"{column:>16}" for column in columns)
+    print(header + (f"{'rps change':>14}{'p99 change':>14}" if baseline else ""))
+    for result in results:
+        line = "".join(f"{result[column]:>16.2f}" if isinstance(result[column], float) else f"{result[column]:>16}"
+                       for column in columns)
+        old = (baseline or {}).get(result["scenario"])
+        if old is not None:
+            line += f"{(result['throughput_rps'] / old['throughput_rps'] - 1) * 100:>+13.1f}%"
+            line += f"{(result['p99_ms'] / old['p99_ms'] - 1) * 100:>+13.1f}%" if old["p99_ms"] else f"{'-':>14}"
+        print(line)
+
+
+def main(module_name: str, scenarios: list[str], description: str):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--scenarios", nargs="+", choices=scenarios, default=scenarios)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--rtt-ms", type=float, default=1.0, help="simulated round trip of the stand-ins")
+    parser.add_argument("--output", help="JSON file for the results, bench_results/<name>-<time>.json by default")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    args = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for name in args.scenarios:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.append(pool.submit(run_scenario, module_name, name, args.requests, args.concurrency,
+                                       args.rtt_ms / 1e3).result())
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = {result["scenario"]: result for result in json.load(file)["results"]}
+    print_table(results, baseline)
+
+    output = args.output or os.path.join("bench_results", f"{module_name}-{time.strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({
+            "meta": {
+                "benchmark": module_name,
+                "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "rtt_ms": args.rtt_ms,
+            },
+            "results": results,
+        }, file, indent=2)
+    print(f"results saved to {output}")
@@ -0,0 +1,161 @@
+import bisect
+import functools
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = []
+
+
+def format_labels(names, values, extra="") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class Metric:
+    """Metric in the Prometheus text format. Samples are kept per tuple of label values.
+    Updates are plain dict operations, they are meant to happen on the event loop of one worker."""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def samples(self):
+        return []
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    """Counter which is either updated by the code or, with function, read at scrape time."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+        self.function = function
+
+    def inc(self, *labels, value: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + value
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, "", self.function())]
+        return [(self.name, format_labels(self.labels, key), value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, value: float = 1.0):
+        self.inc(*labels, value=-value)
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            # per bucket counts, the +Inf bucket, then the sum
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for key, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket",
+                                format_labels(self.labels, key, f'le="{format_value(bound)}"'), cumulative))
+            samples.append((f"{self.name}_count", format_labels(self.labels, key), cumulative))
+            samples.append((f"{self.name}_sum", format_labels(self.labels, key), counts[-1]))
+        return samples
+
+
+def timed(histogram: Histogram, errors: Counter, operation: str):
+    """Decorator of coroutine functions: observes their duration and counts the exceptions they raise."""
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                errors.inc(operation)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, operation)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+http_requests = Counter("http_requests_total", "Handled HTTP requests.", ("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "Time spent handling HTTP requests.",
+                                  ("method", "route"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests being handled.")
+
+
+class MetricsMiddleware:
+    """Measures every HTTP request. Requests are labelled with the path template of their route,
+    so the number of series does not grow with ids in the urls."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec()
+            route = scope.get("route")
+            path = route.path if route is not None else "<unmatched>"
+            http_request_duration.observe(time.perf_counter() - started, scope["method"], path)
+            http_requests.inc(scope["method"], path, str(status_code))
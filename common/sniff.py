@@ -0,0 +1,43 @@
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+SNIFF_LENGTH = 4096  # enough for the chunks in front of acTL of an APNG
+
+
+def is_animated_png(head: bytes) -> bool:
+    """Walks the chunks of a PNG: it is an APNG if acTL comes before the first IDAT. Chunks past the head
+    are not seen, SNIFF_LENGTH covers the usual metadata chunks in front of the image data."""
+    position = 8
+    while position + 8 <= len(head):
+        chunk_type = head[position + 4:position + 8]
+        if chunk_type == b"acTL":
+            return True
+        if chunk_type == b"IDAT":
+            return False
+        position += 12 + int.from_bytes(head[position:position + 4], "big")  # length, type, data, crc
+    return False
+
+
+def is_webp(head: bytes) -> bool:
+    return head.startswith(b"RIFF") and head[8:12] == b"WEBP"
+
+
+def sniff_image_type(head: bytes) -> str | None:
+    """Detects the image format by its signature. An APNG is a PNG with an acTL chunk."""
+    for signature, image_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            if image_type == "png" and is_animated_png(head):
+                return "apng"
+            return image_type
+    if is_webp(head):
+        return "webp"
+    return None
+
+
+def sniff_content_type(head: bytes) -> str:
+    """Content type of an image by its first bytes, for storages without object metadata."""
+    image_type = sniff_image_type(head)
+    return f"image/{image_type}" if image_type else "application/octet-stream"
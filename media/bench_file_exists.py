@@ -0,0 +1,56 @@
+"""Per-request latency of the existence check in front of GET and DELETE.
+
+The MinIO round trip is simulated with a fixed delay, so the numbers show what each mode saves
+regardless of the storage load. Run inside the media container: python bench_file_exists.py [rtt_ms]
+"""
+import asyncio
+import sys
+import time
+import uuid
+
+from cache import ExistenceCache
+from storage import get_storage
+from validators import FileExists
+
+REQUESTS = 2000
+HOT_NAMES = 50
+
+
+class SimulatedMinio:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+
+    async def stat_object(self, bucket_name, object_name):
+        await asyncio.sleep(self.rtt)
+
+
+async def measure(validator: FileExists, names) -> float:
+    started = time.perf_counter()
+    for name in names:
+        await validator(name)
+    return (time.perf_counter() - started) / len(names) * 1e6
+
+
+async def main(rtt: float):
+    handler = get_storage()
+    handler.client = SimulatedMinio(rtt)
+    hot_names = [str(uuid.uuid4()) for _ in range(HOT_NAMES)]
+    names = [hot_names[i % HOT_NAMES] for i in range(REQUESTS)]
+
+    handler.exists_cache = ExistenceCache(maxsize=0, ttl=0, negative_ttl=0)
+    stat_each_time = await measure(FileExists(), names)
+
+    handler.exists_cache = ExistenceCache(maxsize=10000, ttl=60, negative_ttl=60)
+    stat_cached = await measure(FileExists(), names)
+
+    no_stat = await measure(FileExists(check=False), names)
+
+    print(f"simulated stat round trip: {rtt * 1e3:.1f} ms, {REQUESTS} requests over {HOT_NAMES} objects")
+    print(f"{'mode':<28}{'us/request':>12}")
+    print(f"{'stat on every request':<28}{stat_each_time:>12.1f}")
+    print(f"{'stat + existence cache':<28}{stat_cached:>12.1f}")
+    print(f"{'no stat (trusted names)':<28}{no_stat:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(float(sys.argv[1]) / 1e3 if len(sys.argv) > 1 else 0.001))
@@ -0,0 +1,151 @@
+"""Load test of the media API: upload, url, presign and delete endpoints at a fixed concurrency.
+
+MinIO is replaced by an in-memory stand-in which answers after a simulated round trip, so the numbers
+show the cost of this service itself. Thumbnails are off unless MINIO_THUMBNAIL_SIZES is set.
+Run from this directory: python bench_media.py --concurrency 32 --rtt-ms 2
+"""
+import asyncio
+import contextlib
+import os
+import uuid
+
+import httpx
+
+import bench
+
+os.environ.setdefault("MINIO_THUMBNAIL_SIZES", "")
+os.environ["MINIO_STORAGE_BACKEND"] = "minio"  # the stand-in replaces the client of MinioHandler
+
+IMAGE = "test_media/image.jpg"
+SEED = 200
+PRESIGN_BATCH = 10
+
+SCENARIOS = {}
+
+
+def scenario(function):
+    SCENARIOS[function.__name__] = function
+    return function
+
+
+class SimulatedMinio:
+    """The calls of miniopy_async used by MinioHandler on a dict of object sizes, one round trip each.
+    Contents are read and dropped, so the memory of the stand-in does not show up in the results."""
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.objects = {}
+
+    async def round_trip(self):
+        await asyncio.sleep(self.rtt)
+
+    async def put_object(self, bucket_name, object_name, data, length, content_type=None, **kwargs):
+        await self.round_trip()
+        content = data.read()
+        self.objects[object_name] = len(await content if asyncio.iscoroutine(content) else content)
+
+    async def stat_object(self, bucket_name, object_name):
+        await self.round_trip()
+        if object_name not in self.objects:
+            raise KeyError(object_name)
+
+    async def remove_object(self, bucket_name, object_name):
+        await self.round_trip()
+        self.objects.pop(object_name, None)
+
+    async def remove_objects(self, bucket_name, delete_object_list):
+        await self.round_trip()
+        for delete_object in delete_object_list:
+            self.objects.pop(delete_object._name, None)
+        return []
+
+    async def list_objects(self, bucket_name, prefix=None, **kwargs):
+        await self.round_trip()
+        for name in list(self.objects):
+            if prefix is None or name.startswith(prefix):
+                yield name
+
+
+def prepare(rtt: float):
+    from storage import get_storage
+
+    get_storage().client = SimulatedMinio(rtt)
+
+
+def make_client() -> contextlib.AbstractAsyncContextManager:
+    from server import app
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+
+with open(IMAGE, "rb") as image_file:
+    image = image_file.read()
+
+
+async def seed(client, count: int) -> list[str]:
+    """Uploads count distinct files, so deduplication does not turn the uploads into reference writes."""
+    names = []
+    for index in range(count):
+        response = await client.post("/", files={"file": (f"seed{index}.jpg", image + uuid.uuid4().bytes,
+                                                          "image/jpeg")})
+        names.append(response.json()["detail"][0]["file_name"])
+    return names
+
+
+@scenario
+async def upload(client, total):
+    async def request(index):
+        response = await client.post("/", files={"file": ("image.jpg", image + uuid.uuid4().bytes, "image/jpeg")})
+        return response.status_code == 201
+    return request
+
+
+@scenario
+async def upload_duplicate(client, total):
+    async def request(index):
+        response = await client.post("/", files={"file": ("image.jpg", image, "image/jpeg")})
+        return response.status_code == 201
+    return request
+
+
+@scenario
+async def get_url(client, total):
+    names = await seed(client, SEED)
+
+    async def request(index):
+        return (await client.get(f"/{names[index % SEED]}")).status_code == 200
+    return request
+
+
+@scenario
+async def presign(client, total):
+    names = await seed(client, SEED)
+
+    async def request(index):
+        start = index * PRESIGN_BATCH % SEED
+        response = await client.post("/presign", json={"file_names": names[start:start + PRESIGN_BATCH]})
+        return response.status_code == 200
+    return request
+
+
+@scenario
+async def delete(client, total):
+    names = iter(await seed(client, total + SEED))
+
+    async def request(index):
+        return (await client.delete(f"/{next(names)}")).status_code == 200
+    return request
+
+
+@scenario
+async def delete_many(client, total):
+    names = await seed(client, SEED)
+
+    async def request(index):
+        start = index * PRESIGN_BATCH % SEED
+        response = await client.post("/delete", json={"file_names": names[start:start + PRESIGN_BATCH]})
+        return response.status_code == 200
+    return request
+
+
+if __name__ == "__main__":
+    bench.main("bench_media", list(SCENARIOS), __doc__)
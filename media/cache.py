@@ -0,0 +1,35 @@
+import time
+from collections import OrderedDict
+
+
+class ExistenceCache:
+    """Remembers for a few seconds whether an object exists, so repeated checks skip the stat round trip.
+    Every worker has its own cache, so an answer may be stale for at most the TTL."""
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name) -> bool | None:
+        item = self._data.get(name)
+        if item is None or item[1] <= time.monotonic():
+            self._data.pop(name, None)
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(name)
+        self.hits += 1
+        return item[0]
+
+    def set(self, name, exists: bool):
+        if self.maxsize <= 0:
+            return
+
+        self._data[name] = (exists, time.monotonic() + (self.ttl if exists else self.negative_ttl))
+        self._data.move_to_end(name)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
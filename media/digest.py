@@ -0,0 +1,50 @@
+import hashlib
+
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from starlette.formparsers import MultiPartParser, MultiPartException
+from starlette.requests import Request
+
+
+class DigestMultiPartParser(MultiPartParser):
+    """Hashes every file part while the body is spooled, so the upload is read once. The running SHA-256
+    is left on the UploadFile as sha256."""
+
+    def on_headers_finished(self) -> None:
+        super().on_headers_finished()
+        if self._current_part.file is not None:
+            self._current_part.file.sha256 = hashlib.sha256()
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        super().on_part_data(data, start, end)
+        if self._current_part.file is not None:
+            self._current_part.file.sha256.update(data[start:end])
+
+
+class DigestRequest(Request):
+    async def _get_form(self, *, max_files: int | float = 1000, max_fields: int | float = 1000):
+        if self._form is None and self.headers.get("content-type", "").startswith("multipart/form-data"):
+            parser = DigestMultiPartParser(self.headers, self.stream(), max_files=max_files, max_fields=max_fields)
+            try:
+                self._form = await parser.parse()
+            except MultiPartException as exc:
+                raise HTTPException(status_code=400, detail=exc.message)
+        return await super()._get_form(max_files=max_files, max_fields=max_fields)
+
+
+class DigestRoute(APIRoute):
+    """Route whose uploaded files carry the SHA-256 of their content, see DigestMultiPartParser."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def digest_handler(request: Request):
+            return await handler(DigestRequest(request.scope, request.receive))
+
+        return digest_handler
+
+
+def upload_digest(file) -> str | None:
+    """Hex SHA-256 of an UploadFile received on a DigestRoute, None for any other file."""
+    sha256 = getattr(file, "sha256", None)
+    return sha256.hexdigest() if sha256 else None
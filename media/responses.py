@@ -1,43 +1,95 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing_extensions import TypedDict
 
 
+def envelope(**detail):
+    """The detail list of a fixed response, created anew for every instance and shown as the example in the docs."""
+    return Field(default_factory=lambda: [dict(detail)], examples=[[detail]])
+
+
 class UploadFileResponse(BaseModel):
-    detail: list[TypedDict("Response", {"msg": str, "bucket_name": str, "file_name": str})] = [
-        {"msg": "File created", "bucket_name": "string", "file_name": "string"}
-    ]
+    detail: list[TypedDict("Response", {"msg": str, "bucket_name": str, "file_name": str, "deduplicated": bool})] = \
+        Field(examples=[[{"msg": "File created", "bucket_name": "string", "file_name": "string",
+                          "deduplicated": False}]])
+
+    def __init__(self, **kwargs):
+        BaseModel.__init__(self, detail=[
+            {"msg": "File created", "bucket_name": kwargs["bucket_name"], "file_name": kwargs["file_name"],
+             "deduplicated": kwargs.get("deduplicated", False)}
+        ])
+
+
+class UploadFormResponse(BaseModel):
+    detail: list[TypedDict("UploadForm", {"msg": str, "file_name": str, "url": str, "fields": dict[str, str]})] = \
+        Field(examples=[[{"msg": "ok", "file_name": "string", "url": "string", "fields": {}}]])
+
+    def __init__(self, **kwargs):
+        BaseModel.__init__(self, detail=[
+            {"msg": "ok", "file_name": kwargs["file_name"], "url": kwargs["url"], "fields": kwargs["fields"]}
+        ])
+
+
+class UploadedFileResponse(BaseModel):
+    detail: list[TypedDict("Uploaded", {"msg": str, "file_name": str, "size": int, "content_type": str})] = \
+        Field(examples=[[{"msg": "ok", "file_name": "string", "size": 0, "content_type": "string"}]])
 
     def __init__(self, **kwargs):
-        BaseModel.__init__(self, **kwargs)
-        self.detail[0].update(
-            {"bucket_name": kwargs["bucket_name"], "file_name": kwargs["file_name"]}
-        )
+        BaseModel.__init__(self, detail=[
+            {"msg": "ok", "file_name": kwargs["file_name"], "size": kwargs["size"],
+             "content_type": kwargs["content_type"]}
+        ])
 
 
 class MinioServerDisconnected(BaseModel):
-    detail: list[TypedDict("MinioError", {"msg": str})] = [{"msg": "Connection is not established."}]
+    detail: list[TypedDict("MinioError", {"msg": str})] = envelope(msg="Connection is not established.")
 
 
 class UnknownProblem(BaseModel):
-    detail: list[TypedDict("Error", {"msg": str})] = [
-        {"msg": "An unknown exception was thrown while processing the request."}
-    ]
+    detail: list[TypedDict("Error", {"msg": str})] = envelope(
+        msg="An unknown exception was thrown while processing the request."
+    )
 
 
 class StatusOk(BaseModel):
-    detail: list[TypedDict("Ok", {"msg": str})] = [{"msg": "ok"}]
+    detail: list[TypedDict("Ok", {"msg": str})] = envelope(msg="ok")
 
 
 class UrlResponse(BaseModel):
-    detail: list[TypedDict("MinioError", {"msg": str, "url": str})] = [{"msg": "ok", "url": "string"}]
+    detail: list[TypedDict("MinioError", {"msg": str, "url": str, "thumbnails": dict[str, str],
+                                          "thumbnails_pending": bool})] = \
+        Field(examples=[[{"msg": "ok", "url": "string", "thumbnails": {}, "thumbnails_pending": False}]])
 
-    def __init__(self, url="string"):
-        BaseModel.__init__(self)
-        self.detail[0].update(
-            {"url": url}
-        )
+    def __init__(self, url="string", thumbnails=None, thumbnails_pending=False):
+        BaseModel.__init__(self, detail=[
+            {"msg": "ok", "url": url, "thumbnails": thumbnails or {}, "thumbnails_pending": thumbnails_pending}
+        ])
+
+
+class UrlsResponse(BaseModel):
+    detail: list[TypedDict("Urls", {"msg": str, "urls": dict[str, str]})] = \
+        Field(examples=[[{"msg": "ok", "urls": {}}]])
+
+    def __init__(self, urls=None):
+        BaseModel.__init__(self, detail=[{"msg": "ok", "urls": urls or {}}])
+
+
+class DeleteManyResponse(BaseModel):
+    detail: list[TypedDict("Deleted", {"msg": str, "failed": list[str]})] = \
+        Field(examples=[[{"msg": "ok", "failed": []}]])
+
+    def __init__(self, failed=None):
+        BaseModel.__init__(self, detail=[{"msg": "ok", "failed": failed or []}])
 
 
 class NotExists(BaseModel):
-    detail: list[TypedDict("File not exists", {"msg": str})] = [{"msg": "File not exists"}]
+    detail: list[TypedDict("File not exists", {"msg": str})] = envelope(msg="File not exists")
+
+
+class InvalidSignature(BaseModel):
+    detail: list[TypedDict("SignatureError", {"msg": str})] = envelope(
+        msg="The url is expired or its signature is invalid"
+    )
+
 
+class FileTooLarge(BaseModel):
+    detail: list[TypedDict("SizeError", {"msg": str})] = envelope(msg="The file exceeds the size allowed by the form")
@@ -1,13 +1,18 @@
-from io import BytesIO
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, File, HTTPException, status, UploadFile
-from storage import MinioHandler
+from fastapi import APIRouter, FastAPI, File, Form, HTTPException, status, UploadFile, Path, Query
+from fastapi.responses import Response
+from metrics import MetricsMiddleware, Counter, Gauge, CONTENT_TYPE, render as render_metrics
+from storage import get_storage, valid_signature, upload_policy
+from thumbnails import start_pool, stop_pool
+from digest import DigestRoute, upload_digest
 
 import settings
 
 import uuid
 
-from validators import validator_existing_file
+from validators import (validator_file_to_get, validator_file_to_delete, FileNames, FileNamesToDelete,
+                        UploadConditions, UploadedFileName)
 from typing import Annotated
 from responses import (
     UploadFileResponse,
@@ -15,10 +20,25 @@ from responses import (
     UnknownProblem,
     StatusOk,
     NotExists,
-    UrlResponse
+    UrlResponse,
+    UrlsResponse,
+    DeleteManyResponse,
+    InvalidSignature,
+    UploadFormResponse,
+    UploadedFileResponse,
+    FileTooLarge,
 )
 
 
+upload_bytes_in_flight = Gauge("upload_bytes_in_flight", "Bytes of files being uploaded to the s3 storage.")
+Counter("exists_cache_hits_total", "Existence checks served from the cache.",
+        function=lambda: get_storage().exists_cache.hits)
+Counter("exists_cache_misses_total", "Existence checks which missed the cache.",
+        function=lambda: get_storage().exists_cache.misses)
+Gauge("thumbnails_rendering", "Thumbnail renderings in progress.",
+      function=lambda: len(get_storage().rendering))
+
+
 def randname() -> str:
     return str(uuid.uuid4())
 
@@ -28,6 +48,16 @@ A service that allows you to download and download data from S3 storage.
 You can add, extract, and delete files using the POST, GET, and DELETE methods, respectively.
 """
 
+@asynccontextmanager
+async def lifespan(fap: FastAPI):
+    storage = get_storage()
+    await storage.start()
+    start_pool()
+    yield
+    await storage.stop()
+    stop_pool()
+
+
 debug_params = {}
 if not settings.minio_config.DEBUG:
     debug_params.update({"docs_url": None, "redoc_url": None})
@@ -42,11 +72,15 @@ app = FastAPI(
         "name": "Ilya Petrov",
         "email": "klekks@ya.ru",
     },
+    lifespan=lifespan,
     **debug_params
 )
+app.add_middleware(MetricsMiddleware)
+# uploads are hashed while the body is received, for the deduplication in the storage
+uploads = APIRouter(route_class=DigestRoute)
 
 
-@app.post(
+@uploads.post(
     "/",
     response_model=UploadFileResponse,
     status_code=status.HTTP_201_CREATED,
@@ -69,28 +103,173 @@ app = FastAPI(
     },
 )
 async def upload_file_to_minio(file: UploadFile = File(...)):
+    size = file.size or 0
+    upload_bytes_in_flight.inc(value=size)
     try:
-        data = file.file.read()
-
-        file_name = randname()
-
-        data_file = (
-            await MinioHandler()
-            .get_instance()
-            .put_object(
-                file_name=file_name,
-                file_data=BytesIO(data),
-                content_type=file.content_type,
-            )
-        )
+        return await get_storage().upload(file, randname(), upload_digest(file))
+    except Exception as e:
+        if e.__class__.__name__ == "RuntimeError":
+            raise HTTPException(502, detail="Minio server is not available")
+        raise HTTPException(500, detail="Unknown exception during request processing.")
+    finally:
+        upload_bytes_in_flight.dec(value=size)
+
+
+app.include_router(uploads)
+
 
-        return data_file
+@app.post(
+    "/uploads",
+    response_model=UploadFormResponse,
+    status_code=status.HTTP_200_OK,
+    description="Endpoint for uploads which bypass this service. Takes the content type, the size limit and the "
+                "validity of the form as body. Returns a new file name with the url and the form fields of a "
+                "multipart POST which uploads it straight to the storage. Confirm the upload with /uploads/confirm.",
+    tags=["file"],
+    summary="Presigned upload form endpoint",
+    responses={
+        status.HTTP_200_OK: {
+            "model": UploadFormResponse,
+            "description": "Upload form returned successfully.",
+        },
+        status.HTTP_502_BAD_GATEWAY: {
+            "model": MinioServerDisconnected,
+            "description": "Connection with Minio S3 server is not established.",
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "model": UnknownProblem,
+            "description": "An unknown exception was thrown while processing the request.",
+        },
+    },
+)
+async def presign_upload(body: UploadConditions):
+    try:
+        return await get_storage().presigned_upload(randname(), body.content_type, body.max_size, body.expires)
     except Exception as e:
         if e.__class__.__name__ == "RuntimeError":
             raise HTTPException(502, detail="Minio server is not available")
         raise HTTPException(500, detail="Unknown exception during request processing.")
 
 
+@app.post(
+    "/uploads/confirm",
+    response_model=UploadedFileResponse,
+    status_code=status.HTTP_200_OK,
+    description="Endpoint for checking a file uploaded with a presigned form. Takes filename as body. "
+                "Returns its size and the content type detected from its first bytes, and starts its thumbnails.",
+    tags=["file"],
+    summary="Upload confirmation endpoint",
+    responses={
+        status.HTTP_200_OK: {
+            "model": UploadedFileResponse,
+            "description": "The file was uploaded.",
+        },
+        status.HTTP_404_NOT_FOUND: {
+            "model": NotExists,
+            "description": "Nothing was uploaded yet."
+        },
+        status.HTTP_502_BAD_GATEWAY: {
+            "model": MinioServerDisconnected,
+            "description": "Connection with Minio S3 server is not established.",
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "model": UnknownProblem,
+            "description": "An unknown exception was thrown while processing the request.",
+        },
+    },
+)
+async def confirm_upload(body: UploadedFileName):
+    try:
+        uploaded = await get_storage().confirm_upload(body.file_name)
+    except Exception as e:
+        if e.__class__.__name__ == "RuntimeError":
+            raise HTTPException(502, detail="Minio server is not available")
+        raise HTTPException(500, detail="Unknown exception during request processing.")
+    if uploaded is None:
+        raise HTTPException(status_code=404, detail=NotExists().detail)
+    return uploaded
+
+
+@app.get(
+    "/metrics",
+    status_code=status.HTTP_200_OK,
+    description="Endpoint for scraping metrics in the Prometheus text format: request latency and status counts "
+                "per route, MinIO operations, uploads in flight and caches. Every worker process has its own metrics.",
+    tags=["status"],
+    summary="Metrics endpoint",
+    response_class=Response,
+)
+async def get_metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
+
+
+@app.get(
+    "/files/{key:path}",
+    status_code=status.HTTP_200_OK,
+    description="Endpoint behind the download urls of the memory and local storage backends. "
+                "The local backend lets the web server send the file with sendfile.",
+    tags=["file"],
+    summary="Signed file download endpoint",
+    response_class=Response,
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"image/*": {}},
+            "description": "Content of the file.",
+        },
+        status.HTTP_403_FORBIDDEN: {
+            "model": InvalidSignature,
+            "description": "The url is expired or was not issued by this service.",
+        },
+        status.HTTP_404_NOT_FOUND: {
+            "model": NotExists,
+            "description": "File not found."
+        },
+    },
+)
+async def download_signed_file(key: str = Path(min_length=1, max_length=500),
+                               expires: int = Query(), signature: str = Query(max_length=64)):
+    if not valid_signature(key, expires, signature):
+        raise HTTPException(status_code=403, detail=InvalidSignature().detail)
+    try:
+        response = await get_storage().serve(key)
+    except ValueError:
+        response = None
+    if response is None:
+        raise HTTPException(status_code=404, detail=NotExists().detail)
+    return response
+
+
+@app.post(
+    "/files",
+    status_code=status.HTTP_204_NO_CONTENT,
+    description="Endpoint behind the upload forms of the memory and local storage backends, "
+                "it checks the form the way S3 checks a presigned POST policy.",
+    tags=["file"],
+    summary="Signed file upload endpoint",
+    response_class=Response,
+    responses={
+        status.HTTP_403_FORBIDDEN: {
+            "model": InvalidSignature,
+            "description": "The form is expired or was not issued by this service.",
+        },
+        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE: {
+            "model": FileTooLarge,
+            "description": "The file is larger than the form allows.",
+        },
+    },
+)
+async def upload_signed_file(key: str = Form(min_length=1, max_length=500),
+                             content_type: str = Form(alias="Content-Type", max_length=64),
+                             max_size: int = Form(), expires: int = Form(),
+                             signature: str = Form(max_length=64), file: UploadFile = File(...)):
+    if not valid_signature(upload_policy(key, content_type, max_size), expires, signature):
+        raise HTTPException(status_code=403, detail=InvalidSignature().detail)
+    if file.size > max_size:
+        raise HTTPException(status_code=413, detail=FileTooLarge().detail)
+    await get_storage().put(key, file, file.size, content_type)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
 @app.delete(
     "/{file_path}",
     response_model=StatusOk,
@@ -117,9 +296,9 @@ async def upload_file_to_minio(file: UploadFile = File(...)):
         },
     },
 )
-async def delete_file_from_minio(file_path: Annotated[str, validator_existing_file]):
+async def delete_file_from_minio(file_path: Annotated[str, validator_file_to_delete]):
     try:
-        await MinioHandler().get_instance().delete_object(file_path)
+        await get_storage().delete_object(file_path)
         return {"status": "ok"}
     except Exception as e:
         if e.__class__.__name__ == "RuntimeError":
@@ -153,16 +332,86 @@ async def delete_file_from_minio(file_path: Annotated[str, validator_existing_fi
         },
     },
 )
-async def download_file_from_minio(file_path: Annotated[str, validator_existing_file]):
+async def download_file_from_minio(file_path: Annotated[str, validator_file_to_get]):
     try:
-        url = await MinioHandler().get_instance().get_object(file_path)
-        return {"url": url }
+        handler = get_storage()
+        url = await handler.get_object(file_path)
+        thumbnails = await handler.get_thumbnails(file_path)
+        return {"url": url, "thumbnails": thumbnails, "thumbnails_pending": thumbnails is None}
     except Exception as e:
         if e.__class__.__name__ == "RuntimeError":
             raise HTTPException(502, detail="Minio server is not available")
         raise HTTPException(500, detail="Unknown exception during request processing.)")
 
 
+@app.post(
+    "/presign",
+    response_model=UrlsResponse,
+    status_code=status.HTTP_200_OK,
+    description="Endpoint for getting download urls of many files in one request. Takes list of filenames as body. "
+                "Files which do not exist are left out of the result when existence checks are enabled.",
+    tags=["file"],
+    summary="Batch file retrieving endpoint",
+    responses={
+        status.HTTP_200_OK: {
+            "model": UrlsResponse,
+            "description": "Urls returned successfully.",
+        },
+        status.HTTP_502_BAD_GATEWAY: {
+            "model": MinioServerDisconnected,
+            "description": "Connection with Minio S3 server is not established.",
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "model": UnknownProblem,
+            "description": "An unknown exception was thrown while processing the request.",
+        },
+    },
+)
+async def download_files_from_minio(body: FileNames):
+    try:
+        urls = await get_storage().get_objects(
+            body.file_names, check_exists=bool(settings.minio_config.MINIO_STAT_ON_GET)
+        )
+        return UrlsResponse(urls)
+    except Exception as e:
+        if e.__class__.__name__ == "RuntimeError":
+            raise HTTPException(502, detail="Minio server is not available")
+        raise HTTPException(500, detail="Unknown exception during request processing.")
+
+
+@app.post(
+    "/delete",
+    response_model=DeleteManyResponse,
+    status_code=status.HTTP_200_OK,
+    description="Endpoint for removing many files from s3 storage with one multi-object delete. "
+                "Takes list of filenames as body. Missing files are not an error.",
+    tags=["file"],
+    summary="Batch file removing endpoint",
+    responses={
+        status.HTTP_200_OK: {
+            "model": DeleteManyResponse,
+            "description": "Files deleted. Names of files which could not be deleted are listed in failed.",
+        },
+        status.HTTP_502_BAD_GATEWAY: {
+            "model": MinioServerDisconnected,
+            "description": "Connection with Minio S3 server is not established.",
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "model": UnknownProblem,
+            "description": "An unknown exception was thrown while processing the request.",
+        },
+    },
+)
+async def delete_files_from_minio(body: FileNamesToDelete):
+    try:
+        failed = await get_storage().delete_objects(body.file_names)
+        return DeleteManyResponse(failed)
+    except Exception as e:
+        if e.__class__.__name__ == "RuntimeError":
+            raise HTTPException(502, detail="Minio server is not available")
+        raise HTTPException(500, detail="Unknown exception during request processing.")
+
+
 @app.get(
     "/",
     response_model=StatusOk,
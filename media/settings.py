@@ -7,10 +7,32 @@ class MinioAuthSettings(BaseSettings):
 
 
 class MinioStorageConfiguration(BaseSettings):
+    MINIO_STORAGE_BACKEND: str = "minio"  # minio | memory (tests, benchmarks) | local (files on this node)
+    MINIO_LOCAL_PATH: str = "/data"  # root of the local backend, objects are under <path>/<bucket>
+    MINIO_FILES_URL: str = "http://localhost:8081/files"  # GET /files of this service as seen by clients
+    MINIO_FILES_ACCEL_PREFIX: str = ""  # nginx internal location aliasing MINIO_LOCAL_PATH, enables X-Accel-Redirect
     MINIO_PRESIGNED_URL_EXPIRED_HOURS: int = 7 * 24
-    MINIO_UPLOAD_PART_SIZE: int = 10 * 1024 * 1024
+    MINIO_UPLOAD_PART_SIZE: int = 10 * 1024 * 1024  # peak memory of one upload, S3 requires at least 5MB
+    MINIO_PARALLEL_UPLOADS: int = 1  # parts of one upload sent concurrently, each holds a part buffer
+    MINIO_UPLOAD_MAX_SIZE: int = 100 * 1024 * 1024  # largest max_size of a presigned upload form, in bytes
+    MINIO_UPLOAD_URL_MAX_EXPIRES: int = 24 * 60 * 60  # longest validity of a presigned upload form, in seconds
     MINIO_BUCKET_NAME: str = "memes-storage"
     MINIO_URL: str = "storage:9000"
+    MINIO_PUBLIC_URL: str = "http://localhost:9000"  # the storage as seen by clients, urls are signed for it
+    MINIO_REGION: str = "us-east-1"
+    MINIO_MAX_CONNECTIONS: int = 100
+    MINIO_KEEPALIVE_TIMEOUT: float = 30.0  # in seconds
+    MINIO_DEDUPLICATE: int = 1  # store identical uploads once, under their sha256
+    MINIO_THUMBNAIL_SIZES: str = "128,256,512"  # boxes in pixels, empty disables thumbnails
+    MINIO_THUMBNAIL_QUALITY: int = 80
+    MINIO_THUMBNAIL_WORKERS: int = 2  # processes rendering thumbnails
+    MINIO_STAT_ON_GET: int = 1  # 0 -> presign without checking the object, names come from the memes DB
+    MINIO_STAT_ON_DELETE: int = 1  # 0 -> idempotent delete, missing objects are not reported
+    MINIO_PRESIGN_BATCH_MAX: int = 100  # object names per batch presign request
+    MINIO_DELETE_BATCH_MAX: int = 1000  # object names per batch delete request, S3 limit of multi-object delete
+    MINIO_EXISTS_CACHE_SIZE: int = 10000  # 0 disables the existence cache
+    MINIO_EXISTS_CACHE_TTL: float = 5.0  # in seconds
+    MINIO_NOT_EXISTS_CACHE_TTL: float = 1.0  # in seconds
     DEBUG: int = 0
 
 
@@ -1,87 +1,648 @@
-from datetime import timedelta
+import asyncio
+import hashlib
+import hmac
+import os
+import shutil
+import time
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import quote, urlsplit
+
+from aiohttp import ClientSession, TCPConnector
+from fastapi.responses import FileResponse, Response
 from miniopy_async import Minio
-from minio import Minio as SyncMinio
+from miniopy_async.datatypes import PostPolicy
+from miniopy_async.deleteobjects import DeleteObject
 from settings import minio_auth, minio_config
-import asyncio
+from cache import ExistenceCache
+from metrics import Counter, Histogram, timed
+from sniff import sniff_content_type, SNIFF_LENGTH
+from thumbnails import thumbnail_sizes, render, THUMBNAIL_CONTENT_TYPE
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+DELETION_WAIT = 5.0  # seconds an upload waits for deletes of the same content
+
+storage_operation_duration = Histogram("storage_operation_duration_seconds", "Time spent in storage operations.",
+                                       ("operation",))
+storage_operation_errors = Counter("storage_operation_errors_total", "Storage operations which raised an error.",
+                                   ("operation",))
+
+
+def file_digest(file) -> str:
+    """SHA-256 of a seekable file, read in chunks. Blocking: run it in a thread pool."""
+    digest = hashlib.sha256()
+    while chunk := file.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def content_name(digest: str, reference: str) -> str:
+    """Name of one upload of deduplicated content. Every upload gets its own name,
+    while the bytes are stored once, under the digest."""
+    return f"{digest}.{reference}"
+
+
+def blob_key(file_name: str) -> str:
+    digest, separator, _ = file_name.partition(".")
+    return f"sha256/{digest}" if separator else file_name
+
+
+def reference_key(file_name: str) -> str:
+    """Empty object counting one reference to a blob. Names without digest are plain objects."""
+    digest, separator, reference = file_name.partition(".")
+    return f"refs/{digest}/{reference}" if separator else file_name
+
+
+def deletion_prefix(file_name: str) -> str:
+    return f"deleting/{file_name.partition('.')[0]}/"
+
+
+def deletion_key(file_name: str) -> str:
+    """Empty object telling uploads of the same content that a delete may be removing its blob.
+    Every delete writes its own."""
+    return deletion_prefix(file_name) + str(uuid.uuid4())
+
+
+def thumbnail_key(file_name: str, size: int) -> str:
+    """Thumbnails are stored next to the content, so deduplicated uploads share them too."""
+    return f"{blob_key(file_name)}@{size}"
 
 
-class MinioHandler:
+def read_all(data) -> bytes:
+    """Whole content of a file-like object with a sync read, e.g. the file of an UploadFile."""
+    return getattr(data, "file", data).read()
+
+
+def sign(key: str, expires: int) -> str:
+    return hmac.new(minio_auth.MINIO_ROOT_PASSWORD.encode(), f"{key}:{expires}".encode(), "sha256").hexdigest()
+
+
+def signed_url(key: str) -> str:
+    """Url of the /files endpoint of this service, valid for MINIO_PRESIGNED_URL_EXPIRED_HOURS."""
+    expires = int(time.time()) + minio_config.MINIO_PRESIGNED_URL_EXPIRED_HOURS * 60 * 60
+    return f"{minio_config.MINIO_FILES_URL}/{quote(key)}?expires={expires}&signature={sign(key, expires)}"
+
+
+def valid_signature(key: str, expires: int, signature: str) -> bool:
+    return expires >= time.time() and hmac.compare_digest(sign(key, expires), signature)
+
+
+def upload_policy(key: str, content_type: str, max_size: int) -> str:
+    """What the signature of an upload form covers. The prefix keeps it apart from download signatures."""
+    return f"upload:{key}:{content_type}:{max_size}"
+
+
+def signed_upload(key: str, content_type: str, max_size: int, expires: int) -> dict:
+    """Form for POST /files of this service, the counterpart of an S3 presigned POST policy."""
+    expires = int(time.time()) + expires
+    return {"url": minio_config.MINIO_FILES_URL, "fields": {
+        "key": key, "Content-Type": content_type, "max_size": str(max_size), "expires": str(expires),
+        "signature": sign(upload_policy(key, content_type, max_size), expires)}}
+
+
+class StorageBackend(ABC):
+    """Object storage of the service. Deduplication, references, thumbnails and the existence cache are
+    built here on the primitive object operations put/stat/presign/read/remove/list, which every backend
+    implements. Backend methods raise RuntimeError when the storage is not reachable."""
     __instance = None
 
-    minio_url: str = minio_config.MINIO_URL
-    access_key: str = minio_auth.MINIO_ROOT_USER
-    secret_key: str = minio_auth.MINIO_ROOT_PASSWORD
     bucket_name: str = minio_config.MINIO_BUCKET_NAME
 
-    _ = None
+    @staticmethod
+    def get_instance() -> "StorageBackend":
+        """The backend selected by MINIO_STORAGE_BACKEND."""
+        if not StorageBackend.__instance:
+            StorageBackend.__instance = BACKENDS[minio_config.MINIO_STORAGE_BACKEND]()
+
+        return StorageBackend.__instance
 
     @staticmethod
-    def get_instance():
-        """Static access method."""
-        if not MinioHandler.__instance:
-            MinioHandler.__instance = MinioHandler()
+    def reset_instance():
+        """Drops the backend, the next get_instance() creates the one MINIO_STORAGE_BACKEND selects then."""
+        StorageBackend.__instance = None
+
+    def __init__(self):
+        """Does no I/O: connections and the bucket are set up by start()."""
+        self.exists_cache = ExistenceCache(maxsize=minio_config.MINIO_EXISTS_CACHE_SIZE,
+                                           ttl=minio_config.MINIO_EXISTS_CACHE_TTL,
+                                           negative_ttl=minio_config.MINIO_NOT_EXISTS_CACHE_TTL)
+        self.render_failures = ExistenceCache(maxsize=minio_config.MINIO_EXISTS_CACHE_SIZE, ttl=10 * 60,
+                                              negative_ttl=0)
+        self.rendering = {}
+
+    async def start(self):
+        """Called once from the lifespan of the service, inside the running event loop."""
+
+    async def stop(self):
+        for task in list(self.rendering.values()):
+            task.cancel()
+
+    @abstractmethod
+    async def put(self, key: str, data, length: int, content_type: str):
+        """Stores data under key. data has a sync or an async read(size), length is -1 if unknown."""
+
+    @abstractmethod
+    async def stat(self, key: str) -> bool:
+        """Whether there is an object under key."""
+
+    @abstractmethod
+    async def size(self, key: str) -> int | None:
+        """Size of the object in bytes, None if there is no such object."""
+
+    @abstractmethod
+    async def presign(self, key: str) -> str:
+        """Download url of the object, valid for MINIO_PRESIGNED_URL_EXPIRED_HOURS."""
+
+    @abstractmethod
+    async def presign_upload(self, key: str, content_type: str, max_size: int, expires: int) -> dict:
+        """Url and form fields for uploading the object with a multipart POST straight from the client,
+        valid for expires seconds. The storage rejects other keys, content types and sizes above max_size."""
+
+    @abstractmethod
+    async def read(self, key: str, length: int | None = None) -> bytes:
+        """The content of the object, only its first length bytes if length is set."""
+
+    @abstractmethod
+    async def remove(self, key: str):
+        """Removing a missing object is not an error."""
+
+    @abstractmethod
+    async def remove_many(self, keys: list[str]) -> list[str]:
+        """Returns the keys which could not be removed."""
+
+    @abstractmethod
+    def list(self, prefix: str):
+        """Async iterator over the keys starting with prefix, not descending below the last "/" of it."""
+
+    async def serve(self, key: str) -> Response | None:
+        """Response of GET /files/{key} for backends whose urls point to this service."""
+        return None
+
+    @timed(storage_operation_duration, storage_operation_errors, "presigned_get_object")
+    async def presigned_get_object(self, object_name):
+        return await self.presign(object_name)
+
+    @timed(storage_operation_duration, storage_operation_errors, "object_exists")
+    async def object_exists(self, object_name):
+        try:
+            return await self.stat(object_name)
+        except Exception:
+            return False
+
+    async def check_file_name_exists(self, file_name):
+        exists = self.exists_cache.get(file_name)
+        if exists is not None:
+            return exists
+
+        exists = await self.object_exists(reference_key(file_name))
+        self.exists_cache.set(file_name, exists)
+        return exists
+
+    async def get_object(self, filename):
+        return await self.presign(blob_key(filename))
+
+    @timed(storage_operation_duration, storage_operation_errors, "get_objects")
+    async def get_objects(self, filenames, check_exists: bool = False) -> dict:
+        """Presigns many objects at once. Missing objects are left out if check_exists is set."""
+        if check_exists:
+            exists = await asyncio.gather(*(self.check_file_name_exists(name) for name in filenames))
+            filenames = [name for name, found in zip(filenames, exists) if found]
+        return {name: await self.get_object(name) for name in filenames}
+
+    async def get_thumbnails(self, file_name) -> dict | None:
+        """Urls of the thumbnails by size. None if they are not rendered yet, rendering is scheduled then."""
+        sizes = thumbnail_sizes()
+        if not sizes:
+            return {}
+
+        # the largest thumbnail is written last, it marks the whole set as ready
+        marker = thumbnail_key(file_name, sizes[-1])
+        ready = self.exists_cache.get(marker)
+        if ready is None:
+            ready = await self.object_exists(marker)
+            self.exists_cache.set(marker, ready)
+        if not ready:
+            if self.render_failures.get(blob_key(file_name)):
+                return {}
+            self.schedule_thumbnails(file_name)
+            return None
+
+        return {str(size): await self.presign(thumbnail_key(file_name, size)) for size in sizes}
+
+    def schedule_thumbnails(self, file_name):
+        key = blob_key(file_name)
+        if not thumbnail_sizes() or key in self.rendering or self.render_failures.get(key):
+            return
+
+        task = asyncio.create_task(self.make_thumbnails(file_name))
+        self.rendering[key] = task
+        task.add_done_callback(lambda _: self.rendering.pop(key, None))
+
+    @timed(storage_operation_duration, storage_operation_errors, "make_thumbnails")
+    async def make_thumbnails(self, file_name):
+        """Downloads the content and renders its thumbnails in the process pool."""
+        key = blob_key(file_name)
+        try:
+            data = await self.read(key)
+            for size, thumbnail in (await render(data)).items():
+                await self.put(thumbnail_key(file_name, size), BytesIO(thumbnail), len(thumbnail),
+                               THUMBNAIL_CONTENT_TYPE)
+                self.exists_cache.set(thumbnail_key(file_name, size), True)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # not an image or the storage failed: do not retry on every request
+            self.render_failures.set(key, True)
+
+    @timed(storage_operation_duration, storage_operation_errors, "delete_thumbnails")
+    async def delete_thumbnails(self, file_names):
+        keys = [thumbnail_key(name, size) for name in file_names for size in thumbnail_sizes()]
+        if keys:
+            await self.remove_many(keys)
+            for key in keys:
+                self.exists_cache.set(key, False)
+
+    @timed(storage_operation_duration, storage_operation_errors, "is_referenced")
+    async def is_referenced(self, file_name) -> bool:
+        async for _ in self.list(reference_key(file_name).rpartition("/")[0] + "/"):
+            return True
+        return False
+
+    @timed(storage_operation_duration, storage_operation_errors, "delete_object")
+    async def delete_object(self, file_name):
+        """Drops the reference of the name. The blob goes away with its last reference."""
+        await self.remove(reference_key(file_name))
+        self.exists_cache.set(file_name, False)
+        if blob_key(file_name) == file_name:
+            await self.delete_thumbnails([file_name])
+            return
+        marker = deletion_key(file_name)
+        await self.put(marker, BytesIO(b""), 0, "application/octet-stream")
+        try:
+            if not await self.is_referenced(file_name):
+                await self.remove(blob_key(file_name))
+                await self.delete_thumbnails([file_name])
+        finally:
+            await self.remove(marker)
+
+    @timed(storage_operation_duration, storage_operation_errors, "delete_objects")
+    async def delete_objects(self, file_names) -> list:
+        """Removes objects with multi-object delete requests. Returns names which could not be removed."""
+        keys = {reference_key(name): name for name in file_names}
+        failed = [keys.get(key, key) for key in await self.remove_many(list(keys))]
+        deleted = set(file_names).difference(failed)
+        for name in deleted:
+            self.exists_cache.set(name, False)
+
+        released = {blob_key(name): name for name in deleted if blob_key(name) != name}
+        markers = [deletion_key(name) for name in released.values()]
+        await asyncio.gather(*(self.put(marker, BytesIO(b""), 0, "application/octet-stream") for marker in markers))
+        try:
+            referenced = await asyncio.gather(*(self.is_referenced(name) for name in released.values()))
+            orphans = [key for key, still_used in zip(released, referenced) if not still_used]
+            if orphans:
+                await self.remove_many(orphans)
+            await self.delete_thumbnails([released[key] for key in orphans] +
+                                         [name for name in deleted if blob_key(name) == name])
+        finally:
+            if markers:
+                await self.remove_many(markers)
+        return failed
 
-        return MinioHandler.__instance
+    async def wait_for_deletions(self, file_name) -> bool:
+        """Waits until no delete is deciding about the blob of the name. False if markers are still there
+        after DELETION_WAIT seconds, e.g. left by a worker which died while deleting."""
+        prefix = deletion_prefix(file_name)
+        deadline = time.monotonic() + DELETION_WAIT
+        while True:
+            async for _ in self.list(prefix):
+                break
+            else:
+                return True
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.05)
+
+    async def upload(self, file, reference, digest: str | None = None) -> dict | None:
+        """Stores an UploadFile under a new name: deduplicated by its digest when MINIO_DEDUPLICATE is set,
+        under reference otherwise. The digest is computed here unless it was while receiving the file.
+        Thumbnails of new images are scheduled. None if the storage failed."""
+        if minio_config.MINIO_DEDUPLICATE:
+            digest = digest or await asyncio.to_thread(file_digest, file.file)
+            data_file = await self.put_deduplicated(file_data=file, digest=digest, reference=reference,
+                                                    content_type=file.content_type)
+        else:
+            data_file = await self.put_object(file_name=reference, file_data=file, content_type=file.content_type)
+
+        if data_file and not data_file.get("deduplicated") and (file.content_type or "").startswith("image/"):
+            self.schedule_thumbnails(data_file["file_name"])
+        return data_file
+
+    @timed(storage_operation_duration, storage_operation_errors, "presigned_upload")
+    async def presigned_upload(self, file_name, content_type, max_size, expires) -> dict:
+        return {"file_name": file_name, **await self.presign_upload(file_name, content_type, max_size, expires)}
+
+    @timed(storage_operation_duration, storage_operation_errors, "confirm_upload")
+    async def confirm_upload(self, file_name) -> dict | None:
+        """Looks at an object uploaded by a client with a presigned form: its size and the type of its content,
+        told by the first bytes. Thumbnails of images are scheduled. None if nothing was uploaded."""
+        size = await self.size(file_name)
+        if size is None:
+            return None
+
+        content_type = sniff_content_type(await self.read(file_name, SNIFF_LENGTH))
+        self.exists_cache.set(file_name, True)
+        if content_type.startswith("image/"):
+            self.schedule_thumbnails(file_name)
+        return {"file_name": file_name, "size": size, "content_type": content_type}
+
+    @timed(storage_operation_duration, storage_operation_errors, "put_object")
+    async def put_object(self, file_data, file_name, content_type):
+        """file_data may have a sync or an async read(size), e.g. UploadFile."""
+        try:
+            await self.put(file_name, file_data, -1, content_type)
+            self.exists_cache.set(file_name, True)
+            return {"bucket_name": self.bucket_name, "file_name": file_name}
+        except Exception:
+            return None
+
+    @timed(storage_operation_duration, storage_operation_errors, "put_deduplicated")
+    async def put_deduplicated(self, file_data, digest, reference, content_type):
+        """Stores the content under its digest unless it is already there, and adds one reference to it.
+        The reference is written first. A delete of the last other reference either sees it and keeps the blob,
+        or has marked the blob while it decides: the blob is looked at once no marker is left, and uploaded again
+        if that delete removed it. Markers still there after DELETION_WAIT are taken for stale."""
+        try:
+            file_name = content_name(digest, reference)
+            await self.put(reference_key(file_name), BytesIO(b""), 0, "application/octet-stream")
+            deduplicated = await self.wait_for_deletions(file_name) and await self.object_exists(blob_key(file_name))
+            if not deduplicated and await self.put_object(file_data, blob_key(file_name), content_type) is None:
+                await self.remove(reference_key(file_name))
+                return None
+            self.exists_cache.set(file_name, True)
+            return {"bucket_name": self.bucket_name, "file_name": file_name, "deduplicated": deduplicated}
+        except Exception:
+            return None
+
+
+class MinioHandler(StorageBackend):
+    minio_url: str = minio_config.MINIO_URL
+    access_key: str = minio_auth.MINIO_ROOT_USER
+    secret_key: str = minio_auth.MINIO_ROOT_PASSWORD
 
     def __init__(self):
+        super().__init__()
         self.client = Minio(
             self.minio_url,
             access_key=self.access_key,
             secret_key=self.secret_key,
             secure=False,
         )
-        self.sync_client = SyncMinio(
-            self.minio_url,
+        # urls are signed for the host clients use, the region is fixed so signing never needs a request
+        public_url = urlsplit(minio_config.MINIO_PUBLIC_URL)
+        self.signer = Minio(
+            public_url.netloc,
             access_key=self.access_key,
             secret_key=self.secret_key,
-            secure=False,
+            secure=public_url.scheme == "https",
+            region=minio_config.MINIO_REGION,
         )
-        self.make_bucket()
 
-    def make_bucket(self) -> str:
-        if not self.sync_client.bucket_exists(self.bucket_name):
-            self.sync_client.make_bucket(self.bucket_name)
+    async def start(self):
+        self.client.set_session(ClientSession(
+            connector=TCPConnector(limit=minio_config.MINIO_MAX_CONNECTIONS,
+                                   keepalive_timeout=minio_config.MINIO_KEEPALIVE_TIMEOUT)
+        ))
+        await self.make_bucket()
+
+    async def stop(self):
+        await super().stop()
+        await self.client.close_session()
+
+    async def make_bucket(self) -> str:
+        if not await self.client.bucket_exists(self.bucket_name):
+            await self.client.make_bucket(self.bucket_name)
         return self.bucket_name
 
-    async def presigned_get_object(self, object_name):
-        url = await self.client.presigned_get_object(
+    async def put(self, key, data, length, content_type):
+        """Unknown-length data is consumed part by part, so only one part buffer per upload is held in memory."""
+        await self.client.put_object(
             bucket_name=self.bucket_name,
-            object_name=object_name,
-            expires=timedelta(hours=minio_config.MINIO_PRESIGNED_URL_EXPIRED_HOURS),
+            object_name=key,
+            data=data,
+            length=length,
+            content_type=content_type,
+            part_size=minio_config.MINIO_UPLOAD_PART_SIZE,
+            num_parallel_uploads=minio_config.MINIO_PARALLEL_UPLOADS,
         )
-        return url
 
-    async def check_file_name_exists(self, file_name):
+    async def stat(self, key):
         try:
-            await self.client.stat_object(
-                bucket_name=self.bucket_name, object_name=file_name
-            )
+            await self.client.stat_object(bucket_name=self.bucket_name, object_name=key)
             return True
-        except:
+        except Exception:
             return False
 
-    async def get_object(self, filename):
-        return await self.client.presigned_get_object(
-            bucket_name=self.bucket_name, object_name=filename
+    async def size(self, key):
+        try:
+            return (await self.client.stat_object(bucket_name=self.bucket_name, object_name=key)).size
+        except Exception:
+            return None
+
+    async def presign(self, key):
+        return await self.signer.presigned_get_object(
+            bucket_name=self.bucket_name,
+            object_name=key,
+            expires=timedelta(hours=minio_config.MINIO_PRESIGNED_URL_EXPIRED_HOURS),
         )
 
-    async def delete_object(self, file_name):
-        await self.client.remove_object(
-            bucket_name=self.bucket_name, object_name=file_name
+    async def presign_upload(self, key, content_type, max_size, expires):
+        """A presigned POST policy: unlike a presigned PUT url it lets MinIO enforce the size and content type."""
+        policy = PostPolicy(self.bucket_name, datetime.now(timezone.utc) + timedelta(seconds=expires))
+        policy.add_equals_condition("key", key)
+        policy.add_equals_condition("Content-Type", content_type)
+        policy.add_content_length_range_condition(1, max_size)
+        fields = await self.signer.presigned_post_policy(policy)
+        return {"url": f"{minio_config.MINIO_PUBLIC_URL.rstrip('/')}/{self.bucket_name}",
+                "fields": {"key": key, "Content-Type": content_type, **fields}}
+
+    async def read(self, key, length=None):
+        response = await self.client.get_object(bucket_name=self.bucket_name, object_name=key, length=length or 0)
+        try:
+            return await response.read()
+        finally:
+            response.release()
+
+    async def remove(self, key):
+        await self.client.remove_object(bucket_name=self.bucket_name, object_name=key)
+
+    async def remove_many(self, keys):
+        errors = await self.client.remove_objects(
+            bucket_name=self.bucket_name, delete_object_list=[DeleteObject(key) for key in keys]
         )
+        return [error.name for error in errors]
 
-    async def put_object(self, file_data, file_name, content_type):
+    async def list(self, prefix):
+        async for item in self.client.list_objects(bucket_name=self.bucket_name, prefix=prefix):
+            yield item.object_name
+
+
+class InMemoryStorage(StorageBackend):
+    """Objects in a dict of this process, for tests and benchmarks. Urls point to GET /files of the service."""
+
+    def __init__(self):
+        super().__init__()
+        self.objects = {}
+
+    async def put(self, key, data, length, content_type):
+        content = data.read()
+        self.objects[key] = (await content if asyncio.iscoroutine(content) else content, content_type)
+
+    async def stat(self, key):
+        return key in self.objects
+
+    async def size(self, key):
+        return len(self.objects[key][0]) if key in self.objects else None
+
+    async def presign(self, key):
+        return signed_url(key)
+
+    async def presign_upload(self, key, content_type, max_size, expires):
+        return signed_upload(key, content_type, max_size, expires)
+
+    async def read(self, key, length=None):
+        return self.objects[key][0][:length]
+
+    async def remove(self, key):
+        self.objects.pop(key, None)
+
+    async def remove_many(self, keys):
+        for key in keys:
+            self.objects.pop(key, None)
+        return []
+
+    async def list(self, prefix):
+        directory = prefix.rpartition("/")[0]
+        for key in list(self.objects):
+            if key.startswith(prefix) and key.rpartition("/")[0] == directory:
+                yield key
+
+    async def serve(self, key):
+        if key not in self.objects:
+            return None
+        content, content_type = self.objects[key]
+        return Response(content=content, media_type=content_type)
+
+
+class LocalFileStorage(StorageBackend):
+    """Objects as files under MINIO_LOCAL_PATH/<bucket>, for single-node deployments.
+    Urls point to GET /files of the service, which hands the file to the web server to send with sendfile."""
+
+    def __init__(self):
+        super().__init__()
+        self.root = Path(minio_config.MINIO_LOCAL_PATH, self.bucket_name).resolve()
+
+    def path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if not path.is_relative_to(self.root) or path == self.root:
+            raise ValueError(f"Invalid object key: {key}")
+        return path
+
+    async def start(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def write(self, key: str, data):
+        # written next to the target and renamed, so readers never see a partial file
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(f".{path.name}.{uuid.uuid4()}")
         try:
-            object_name = file_name
-            await self.client.put_object(
-                bucket_name=self.bucket_name,
-                object_name=object_name,
-                data=file_data,
-                content_type=content_type,
-                length=-1,
-                part_size=minio_config.MINIO_UPLOAD_PART_SIZE,
-            )
-            data_file = {"bucket_name": self.bucket_name, "file_name": object_name}
-            return data_file
-        except:
+            with open(temporary, "wb") as file:
+                shutil.copyfileobj(getattr(data, "file", data), file, HASH_CHUNK_SIZE)
+            os.replace(temporary, path)
+        finally:
+            temporary.unlink(missing_ok=True)
+
+    async def put(self, key, data, length, content_type):
+        await asyncio.to_thread(self.write, key, data)
+
+    def file_size(self, key: str) -> int | None:
+        path = self.path(key)
+        return path.stat().st_size if path.is_file() else None
+
+    async def stat(self, key):
+        return await asyncio.to_thread(self.file_size, key) is not None
+
+    async def size(self, key):
+        return await asyncio.to_thread(self.file_size, key)
+
+    async def presign(self, key):
+        return signed_url(key)
+
+    async def presign_upload(self, key, content_type, max_size, expires):
+        return signed_upload(key, content_type, max_size, expires)
+
+    def read_head(self, key: str, length: int | None) -> bytes:
+        with open(self.path(key), "rb") as file:
+            return file.read(length if length is not None else -1)
+
+    async def read(self, key, length=None):
+        return await asyncio.to_thread(self.read_head, key, length)
+
+    def unlink(self, keys: list[str]) -> list[str]:
+        failed = []
+        for key in keys:
+            try:
+                self.path(key).unlink(missing_ok=True)
+            except OSError:
+                failed.append(key)
+        return failed
+
+    async def remove(self, key):
+        await asyncio.to_thread(lambda: self.path(key).unlink(missing_ok=True))
+
+    async def remove_many(self, keys):
+        return await asyncio.to_thread(self.unlink, keys)
+
+    def scan(self, prefix: str) -> list[str]:
+        directory, _, name = prefix.rpartition("/")
+        try:
+            entries = os.scandir(self.path(directory) if directory else self.root)
+        except FileNotFoundError:
+            return []
+        with entries:
+            return [f"{directory}/{entry.name}" if directory else entry.name for entry in entries
+                    if entry.name.startswith(name) and not entry.name.startswith(".") and entry.is_file()]
+
+    async def list(self, prefix):
+        for key in await asyncio.to_thread(self.scan, prefix):
+            yield key
+
+    def sniff_file(self, key: str) -> tuple[Path, str] | None:
+        path = self.path(key)
+        if not path.is_file():
             return None
+        with open(path, "rb") as file:
+            return path, sniff_content_type(file.read(SNIFF_LENGTH))
+
+    async def serve(self, key):
+        found = await asyncio.to_thread(self.sniff_file, key)
+        if found is None:
+            return None
+        path, content_type = found
+        if minio_config.MINIO_FILES_ACCEL_PREFIX:
+            # nginx sends the file itself: X-Accel-Redirect to an internal location aliasing MINIO_LOCAL_PATH
+            return Response(media_type=content_type, headers={
+                "X-Accel-Redirect": f"{minio_config.MINIO_FILES_ACCEL_PREFIX}/{self.bucket_name}/{quote(key)}"})
+        return FileResponse(path, media_type=content_type)
+
+BACKENDS = {"minio": MinioHandler, "memory": InMemoryStorage, "local": LocalFileStorage}
+
+
+def get_storage() -> StorageBackend:
+    return StorageBackend.get_instance()
@@ -0,0 +1,109 @@
+"""The memory and local storage backends through the API. They need no MinIO, so every test runs against both."""
+import hashlib
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from fastapi.testclient import TestClient
+import pytest
+
+from server import app
+from settings import minio_config
+from storage import StorageBackend, blob_key, deletion_key
+import storage
+
+
+@pytest.fixture(scope="module", params=["memory", "local"])
+def client(request, tmp_path_factory):
+    configured = minio_config.MINIO_STORAGE_BACKEND, minio_config.MINIO_LOCAL_PATH
+    minio_config.MINIO_STORAGE_BACKEND = request.param
+    minio_config.MINIO_LOCAL_PATH = str(tmp_path_factory.mktemp("storage"))
+    StorageBackend.reset_instance()
+    try:
+        with TestClient(app) as client:
+            yield client
+    finally:
+        minio_config.MINIO_STORAGE_BACKEND, minio_config.MINIO_LOCAL_PATH = configured
+        StorageBackend.reset_instance()
+
+
+@pytest.fixture(scope="module")
+def image():
+    with open("test_media/image.jpg", "rb") as file:
+        return file.read()
+
+
+def upload(client, content) -> dict:
+    response = client.post("/", files={"file": ("image.jpg", content, "image/jpeg")})
+    assert response.status_code == 201
+    return response.json()['detail'][0]
+
+
+def download(client, file_name):
+    """Follows the download url of the file, which points to /files of this service."""
+    response = client.get(f"/{file_name}")
+    assert response.status_code == 200
+    url = response.json()['detail'][0]['url']
+    assert url.startswith(f"{minio_config.MINIO_FILES_URL}/")
+    return url, client.get(urlsplit(url).path + "?" + urlsplit(url).query)
+
+
+def test_upload_and_download(client, image):
+    file_name = upload(client, image)['file_name']
+
+    _, response = download(client, file_name)
+    assert response.status_code == 200
+    assert response.content == image
+    assert response.headers['content-type'] == "image/jpeg"
+
+
+def test_deduplicated_upload_and_delete(client, image):
+    content = image + b"dedup"
+    first = upload(client, content)
+    second = upload(client, content)
+    assert second['deduplicated']
+
+    first_url, _ = download(client, first['file_name'])
+    second_url, _ = download(client, second['file_name'])
+    assert first_url == second_url
+
+    assert client.delete(f"/{first['file_name']}").status_code == 200
+    assert client.get(f"/{first['file_name']}").status_code == 404
+    assert download(client, second['file_name'])[1].content == content
+
+    assert client.delete(f"/{second['file_name']}").status_code == 200
+    assert client.get(f"/{second['file_name']}").status_code == 404
+    assert client.get(urlsplit(second_url).path + "?" + urlsplit(second_url).query).status_code == 404
+
+
+def test_upload_after_interrupted_delete(client, image, monkeypatch):
+    content = image + b"interrupted"
+    first = upload(client, content)
+    assert first['file_name'].partition(".")[0] == hashlib.sha256(content).hexdigest()
+
+    # a delete which removed the blob and died before dropping its marker
+    backend = StorageBackend.get_instance()
+    client.portal.call(backend.put, deletion_key(first['file_name']), BytesIO(b""), 0, "application/octet-stream")
+    client.portal.call(backend.remove, blob_key(first['file_name']))
+    monkeypatch.setattr(storage, "DELETION_WAIT", 0.1)
+
+    second = upload(client, content)
+    assert not second['deduplicated']
+    assert download(client, second['file_name'])[1].content == content
+
+
+def test_signed_form_upload(client, image):
+    response = client.post("/uploads", json={"content_type": "image/jpeg", "max_size": len(image), "expires": 60})
+    assert response.status_code == 200
+    form = response.json()['detail'][0]
+    assert form['url'] == minio_config.MINIO_FILES_URL
+
+    files = {"file": ("image", image, "image/jpeg")}
+    tampered = {**form['fields'], "max_size": str(len(image) + 1)}
+    assert client.post("/files", data=tampered, files=files).status_code == 403
+    assert client.post("/files", data=form['fields'], files={"file": ("image", image + b"0")}).status_code == 413
+    assert client.post("/files", data=form['fields'], files=files).status_code == 204
+
+    response = client.post("/uploads/confirm", json={"file_name": form['file_name']})
+    assert response.status_code == 200
+    assert response.json()['detail'][0]['size'] == len(image)
+    assert download(client, form['file_name'])[1].content == image
@@ -1,11 +1,21 @@
 from server import app
+from settings import minio_config
 from fastapi.testclient import TestClient
+import httpx
 import pytest
+import time
 
 
 client = TestClient(app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def lifespan():
+    # One event loop for the whole module: the storage connection pool is created in the lifespan.
+    with client:
+        yield
+
+
 @pytest.mark.dependency()
 def test_connection():
     response = client.get("/")
@@ -100,3 +110,120 @@ def test_empty_delete_file():
     response = client.delete("/")
 
     assert response.status_code == 405
+
+
+@pytest.mark.dependency(depends=["test_create_and_get"])
+def test_presign_many():
+    test_filename = "test_media/image.jpg"
+    filenames = []
+    for _ in range(3):
+        response = client.post("/",
+                               files={"file": (test_filename, open(test_filename, "rb"))})
+        filenames.append(response.json()['detail'][0]['file_name'])
+
+    response = client.post("/presign", json={"file_names": filenames})
+
+    assert response.status_code == 200
+    assert response.json()['detail'][0]['msg'] == 'ok'
+    assert set(response.json()['detail'][0]['urls']) == set(filenames)
+
+
+@pytest.mark.dependency(depends=["test_presign_many"])
+def test_presign_many_empty():
+    response = client.post("/presign", json={"file_names": []})
+
+    assert response.status_code == 422
+
+
+@pytest.mark.dependency(depends=["test_create_and_delete"])
+def test_delete_many():
+    test_filename = "test_media/image.jpg"
+    filenames = []
+    for _ in range(3):
+        response = client.post("/",
+                               files={"file": (test_filename, open(test_filename, "rb"))})
+        filenames.append(response.json()['detail'][0]['file_name'])
+
+    response = client.post("/delete", json={"file_names": filenames + ["abracadabra"]})
+
+    assert response.status_code == 200
+    assert response.json() == {"detail": [{"msg": "ok", "failed": []}]}
+    for filename in filenames:
+        assert client.get(f"/{filename}").status_code == 404
+
+
+@pytest.mark.dependency(depends=["test_create_and_delete"])
+def test_deduplicated_upload():
+    test_filename = "test_media/image.jpg"
+    first = client.post("/", files={"file": (test_filename, open(test_filename, "rb"))}).json()['detail'][0]
+    second = client.post("/", files={"file": (test_filename, open(test_filename, "rb"))}).json()['detail'][0]
+
+    assert first['file_name'] != second['file_name']
+    assert second['deduplicated']
+    assert client.get(f"/{first['file_name']}").json()['detail'][0]['url'] == \
+           client.get(f"/{second['file_name']}").json()['detail'][0]['url']
+
+    assert client.delete(f"/{first['file_name']}").status_code == 200
+    assert client.get(f"/{first['file_name']}").status_code == 404
+    assert client.get(f"/{second['file_name']}").status_code == 200
+
+    assert client.delete(f"/{second['file_name']}").status_code == 200
+    assert client.get(f"/{second['file_name']}").status_code == 404
+
+
+@pytest.mark.dependency(depends=["test_create_and_get"])
+def test_thumbnails():
+    test_filename = "test_media/image.jpg"
+    response = client.post("/", files={"file": (test_filename, open(test_filename, "rb"), "image/jpeg")})
+    filename = response.json()['detail'][0]['file_name']
+
+    for _ in range(50):
+        response_body = client.get(f"/{filename}").json()['detail'][0]
+        if not response_body['thumbnails_pending']:
+            break
+        time.sleep(0.1)
+
+    assert not response_body['thumbnails_pending']
+    assert set(response_body['thumbnails']) == {"128", "256", "512"}
+
+
+@pytest.mark.dependency(depends=["test_create_and_get"])
+def test_metrics():
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert 'http_requests_total{method="POST",route="/",status="201"}' in response.text
+    assert 'storage_operation_duration_seconds_count{operation="put_' in response.text
+
+
+@pytest.mark.dependency(depends=["test_connection"])
+def test_files_invalid_signature():
+    response = client.get("/files/abracadabra?expires=1&signature=0")
+    assert response.status_code == 403
+
+
+def post_form(form, content, content_type):
+    """Uploads like a client would: to the storage, or to /files of the service for the memory and local backends."""
+    files = {"file": ("image", content, content_type)}
+    if form['url'] == minio_config.MINIO_FILES_URL:
+        return client.post("/files", data=form['fields'], files=files)
+    return httpx.post(form['url'], data=form['fields'], files=files)
+
+
+@pytest.mark.dependency(depends=["test_create_and_get"])
+def test_direct_upload():
+    with open("test_media/image.jpg", "rb") as file:
+        content = file.read()
+    response = client.post("/uploads", json={"content_type": "image/jpeg", "max_size": len(content), "expires": 60})
+    assert response.status_code == 200
+    form = response.json()['detail'][0]
+
+    assert client.post("/uploads/confirm", json={"file_name": form['file_name']}).status_code == 404
+    assert post_form(form, content + b"0", "image/jpeg").status_code >= 400
+    assert post_form(form, content, "image/jpeg").status_code in (200, 201, 204)
+
+    response = client.post("/uploads/confirm", json={"file_name": form['file_name']})
+    assert response.status_code == 200
+    assert response.json()['detail'][0]['size'] == len(content)
+    assert response.json()['detail'][0]['content_type'] == "image/jpeg"
+    assert client.get(f"/{form['file_name']}").status_code == 200
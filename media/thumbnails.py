@@ -0,0 +1,50 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from settings import minio_config
+
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_CONTENT_TYPE = "image/webp"
+
+executor: ProcessPoolExecutor | None = None
+
+
+def thumbnail_sizes() -> list[int]:
+    return sorted(int(size) for size in minio_config.MINIO_THUMBNAIL_SIZES.split(",") if size.strip())
+
+
+def render_thumbnails(data: bytes, sizes: list[int]) -> dict[int, bytes]:
+    """Scales the image to fit every size x size box. Runs in a worker process."""
+    thumbnails = {}
+    with Image.open(BytesIO(data)) as image:
+        image.seek(0)  # first frame of animated images
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        for size in sizes:
+            variant = image.copy()
+            variant.thumbnail((size, size))
+            buffer = BytesIO()
+            variant.save(buffer, THUMBNAIL_FORMAT, quality=minio_config.MINIO_THUMBNAIL_QUALITY)
+            thumbnails[size] = buffer.getvalue()
+    return thumbnails
+
+
+def start_pool():
+    global executor
+    if executor is None and thumbnail_sizes():
+        executor = ProcessPoolExecutor(max_workers=minio_config.MINIO_THUMBNAIL_WORKERS)
+
+
+def stop_pool():
+    global executor
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+        executor = None
+
+
+async def render(data: bytes) -> dict[int, bytes]:
+    """Renders the thumbnails in the process pool, so the event loop never decodes images."""
+    start_pool()
+    return await asyncio.get_running_loop().run_in_executor(executor, render_thumbnails, data, thumbnail_sizes())
@@ -1,7 +1,9 @@
 from fastapi import Path, Depends, HTTPException
+from pydantic import BaseModel, Field
 
-from storage import MinioHandler
+from storage import get_storage
 from responses import NotExists
+from settings import minio_config
 
 
 class ValidPath:
@@ -18,11 +20,41 @@ validator_acceptable_path = Depends(ValidPath())
 
 
 class FileExists:
+    def __init__(self, check: bool = True):
+        self.check = check
+
     async def __call__(self, file_path: str = validator_acceptable_path) -> str | None:
-        client = MinioHandler().get_instance()
+        if not self.check:
+            return file_path
+
+        client = get_storage()
         if await client.check_file_name_exists(file_path):
             return file_path
         raise HTTPException(status_code=404, detail=NotExists().detail)
 
 
 validator_existing_file = Depends(FileExists())
+validator_file_to_get = Depends(FileExists(check=bool(minio_config.MINIO_STAT_ON_GET)))
+validator_file_to_delete = Depends(FileExists(check=bool(minio_config.MINIO_STAT_ON_DELETE)))
+
+
+class FileNames(BaseModel):
+    file_names: list[str] = Field(min_length=1, max_length=minio_config.MINIO_PRESIGN_BATCH_MAX,
+                                  description="The s3-relative paths to the files")
+
+
+class FileNamesToDelete(BaseModel):
+    file_names: list[str] = Field(min_length=1, max_length=minio_config.MINIO_DELETE_BATCH_MAX,
+                                  description="The s3-relative paths to the files")
+
+
+class UploadConditions(BaseModel):
+    content_type: str = Field(pattern=r"^[\w.+-]+/[\w.+-]+$", max_length=64,
+                              description="The only content type the client may upload")
+    max_size: int = Field(ge=1, le=minio_config.MINIO_UPLOAD_MAX_SIZE, description="Size limit of the file in bytes")
+    expires: int = Field(ge=1, le=minio_config.MINIO_UPLOAD_URL_MAX_EXPIRES,
+                         description="Seconds the upload form stays valid")
+
+
+class UploadedFileName(BaseModel):
+    file_name: str = Field(min_length=1, max_length=500, description="The s3-relative path of the uploaded file")
@@ -0,0 +1,151 @@
+"""Benchmark of the media transports: http requests to the media service against in-process calls of its
+storage layer (MEDIA_TRANSPORT=local), through GET/POST/DELETE /memes.
+
+Both transports use the in-memory storage backend of the media service and the memes stand-in of
+bench_memes, so only the cost of the transport differs. The http transport reaches the media app through an
+in-process ASGI transport plus the simulated round trip of the network hop, which the local transport does not
+have. Run from this directory: python bench_media_transport.py --concurrency 32 --rtt-ms 0.5
+"""
+import asyncio
+import contextlib
+import functools
+import itertools
+import os
+import uuid
+from io import BytesIO
+
+import httpx
+
+import bench
+import bench_memes
+
+os.environ.setdefault("MINIO_ROOT_USER", "bench")
+os.environ.setdefault("MINIO_ROOT_PASSWORD", "bench-secret")
+os.environ["MINIO_STORAGE_BACKEND"] = "memory"
+os.environ["MINIO_SIGN_LOCALLY"] = "0"  # urls signed here would never reach either transport
+os.environ["MINIO_THUMBNAIL_SIZES"] = ""
+
+SEED = 200
+TRANSPORTS = ("http", "local")
+
+SCENARIOS = {}
+rtt = 0.0
+
+
+class RoundTripTransport(httpx.AsyncBaseTransport):
+    """Delays every request by the round trip of the network between the services."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, delay: float):
+        self.transport = transport
+        self.delay = delay
+
+    async def handle_async_request(self, request):
+        await asyncio.sleep(self.delay)
+        return await self.transport.handle_async_request(request)
+
+
+async def use_transport(transport: str, seed: int = SEED) -> list[str]:
+    """Switches media_connector to the transport and stores seed images. Returns their names."""
+    import media_connector
+    import media_local
+    from settings import media_settings
+
+    if transport == "local":
+        media_settings.MEDIA_TRANSPORT = "local"
+        await media_connector.open_media()
+    else:
+        media_app = media_local.import_media("server").app
+        media_connector.aclient = httpx.AsyncClient(
+            base_url="http://media", transport=RoundTripTransport(httpx.ASGITransport(app=media_app), rtt))
+        await media_local.start()  # the storage backend which the media app uses, the memory one does no I/O
+
+    media_local.backend.objects = ContentlessObjects()
+    names = [str(uuid.uuid4()) for _ in range(seed)]
+    for name in names:
+        await media_local.backend.put_object(BytesIO(bench_memes.image), name, "image/jpeg")
+    return names
+
+
+class ContentlessObjects(dict):
+    """Objects of the in-memory storage without their content, which no scenario reads back.
+    Otherwise the stored uploads would dominate the peak RSS."""
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, (b"", value[1]))
+
+
+def scenario(function):
+    for transport in TRANSPORTS:
+        SCENARIOS[f"{function.__name__}_{transport}"] = functools.partial(function, transport)
+    return function
+
+
+def prepare(delay: float):
+    """The memes stand-in answers at once: the round trip is only paid for the hop to the media service."""
+    global rtt
+    rtt = delay
+    bench_memes.prepare(0.0)
+
+
+def make_client() -> contextlib.AbstractAsyncContextManager:
+    return bench_memes.make_client()
+
+
+async def seed_memes(transport: str) -> itertools.count:
+    """Memes pointing to the stored images. Returns the ids of the memes."""
+    first = len(bench_memes.memes.rows) + 1
+    for index, name in enumerate(await use_transport(transport)):
+        bench_memes.memes.add(f"stored{index}.jpg", name, f"stored meme {index}", "image/jpeg")
+    return itertools.count(first)
+
+
+@scenario
+async def get(transport, client, total):
+    first = next(await seed_memes(transport))
+    from media_connector import url_cache
+    url_cache.maxsize = 0  # every request reaches the transport
+
+    async def request(index):
+        return (await client.get(f"/memes/{first + index % SEED}")).status_code == 200
+    return request
+
+
+@scenario
+async def list_with_urls(transport, client, total):
+    first = next(await seed_memes(transport))
+    from media_connector import url_cache
+    url_cache.maxsize = 0
+
+    async def request(index):
+        offset = first - 1 + index * 10 % SEED
+        return (await client.get(f"/memes?offset={offset}&limit=10&include_urls=true")).status_code == 200
+    return request
+
+
+@scenario
+async def create(transport, client, total):
+    await use_transport(transport, seed=0)
+
+    async def request(index):
+        response = await client.post("/memes?text=bench",
+                                     files={"file": ("image.jpg", bench_memes.image + uuid.uuid4().bytes,
+                                                     "image/jpeg")})
+        return response.status_code == 201
+    return request
+
+
+@scenario
+async def update_image(transport, client, total):
+    ids = await seed_memes(transport)
+    first = next(ids)
+
+    async def request(index):
+        response = await client.put(f"/memes/{first + index % SEED}",
+                                    files={"file": ("image.jpg", bench_memes.image + uuid.uuid4().bytes,
+                                                    "image/jpeg")})
+        return response.status_code == 200
+    return request
+
+
+if __name__ == "__main__":
+    bench.main("bench_media_transport", list(SCENARIOS), __doc__)
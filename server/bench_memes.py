@@ -0,0 +1,224 @@
+"""Load test of the memes API: POST/GET/PUT/DELETE /memes at a fixed concurrency.
+
+Postgres and the media service are replaced by in-memory stand-ins which answer after a simulated
+round trip, so the numbers show the cost of this service itself and runs are comparable between
+machines. Run from this directory: python bench_memes.py --concurrency 32 --rtt-ms 2
+"""
+import asyncio
+import contextlib
+import itertools
+import json
+import uuid
+
+import httpx
+
+import bench
+
+IMAGE = "test_media/image.jpg"
+SEED = 1000
+
+SCENARIOS = {}
+
+
+def scenario(function):
+    SCENARIOS[function.__name__] = function
+    return function
+
+
+class InMemoryMemes:
+    """Stand-in for the queries of Meme: a dict of rows, every call costs one round trip."""
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.rows = {}
+        self.ids = itertools.count(1)
+        self.version = 0
+
+    async def round_trip(self):
+        await asyncio.sleep(self.rtt)
+
+    def meme(self, row):
+        from model import Meme
+        return Meme(**row)
+
+    def add(self, old_name, filename, text, mimetype):
+        meme_id = next(self.ids)
+        self.rows[meme_id] = dict(meme_id=meme_id, text=text, new_file_name=filename, file_name=old_name,
+                                  mimetype=mimetype)
+        self.version += 1
+        return self.rows[meme_id]
+
+    async def create_meme(self, old_name, filename, text, mimetype):
+        await self.round_trip()
+        return {key: str(value) for key, value in self.add(old_name, filename, text, mimetype).items()}
+
+    async def create_memes(self, rows):
+        await self.round_trip()
+        return [self.meme(self.add(row["old_name"], row["filename"], row["text"], row["mimetype"])) for row in rows]
+
+    async def get_meme_by_id(self, ident):
+        await self.round_trip()
+        row = self.rows.get(ident)
+        return self.meme(row) if row is not None else None
+
+    async def get_memes(self, offset, limit):
+        await self.round_trip()
+        return [self.meme(row) for row in itertools.islice(self.rows.values(), offset, offset + limit)]
+
+    async def get_memes_after(self, last_seen, limit):
+        await self.round_trip()
+        rows = [row for meme_id, row in self.rows.items() if meme_id > last_seen][:limit + 1]
+        return [self.meme(row) for row in rows[:limit]], len(rows) > limit
+
+    async def update_by_id(self, ident, **kwargs):
+        await self.round_trip()
+        row = self.rows.get(ident)
+        if row is None:
+            return None, None
+        old_file_name = row["new_file_name"]
+        self.version += any(row[name] != value for name, value in kwargs.items())
+        row.update(kwargs)
+        return self.meme(row), old_file_name
+
+    async def delete_by_id(self, ident):
+        await self.round_trip()
+        row = self.rows.pop(ident, None)
+        self.version += row is not None
+        return self.meme(row) if row is not None else None
+
+    async def delete_by_ids(self, idents):
+        await self.round_trip()
+        rows = [self.rows.pop(ident) for ident in idents if ident in self.rows]
+        self.version += bool(rows)
+        return [self.meme(row) for row in rows]
+
+    async def get_version(self):
+        await self.round_trip()
+        return self.version
+
+
+def media_stand_in(rtt: float):
+    """Answers of the media service, in its response format."""
+    async def handle(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(rtt)
+        if request.method == "POST" and request.url.path == "/":
+            await request.aread()
+            detail = {"msg": "File created", "bucket_name": "memes", "file_name": str(uuid.uuid4()),
+                      "deduplicated": False}
+        elif request.method == "POST" and request.url.path == "/presign":
+            names = json.loads(await request.aread())["file_names"]
+            detail = {"msg": "ok", "urls": {name: f"http://storage:9000/memes/{name}?X-Amz-Signature=0"
+                                            for name in names}}
+        elif request.method == "POST" and request.url.path == "/delete":
+            detail = {"msg": "ok", "failed": []}
+        elif request.method == "GET":
+            detail = {"msg": "ok", "url": f"http://storage:9000/memes{request.url.path}?X-Amz-Signature=0",
+                      "thumbnails": {}, "thumbnails_pending": False}
+        else:
+            detail = {"msg": "ok"}
+        return httpx.Response(200, json={"detail": [detail]})
+
+    return httpx.MockTransport(handle)
+
+
+memes: InMemoryMemes | None = None
+
+
+def prepare(rtt: float):
+    global memes
+    import media_connector
+    from model import Meme
+
+    memes = InMemoryMemes(rtt)
+    for name in ("create_meme", "create_memes", "get_meme_by_id", "get_memes", "get_memes_after", "update_by_id",
+                 "delete_by_id", "delete_by_ids", "get_version"):
+        setattr(Meme, name, staticmethod(getattr(memes, name)))
+    media_connector.aclient = httpx.AsyncClient(base_url="http://media", transport=media_stand_in(rtt))
+    for index in range(SEED):
+        memes.add(f"seed{index}.jpg", str(uuid.uuid4()), f"seed meme {index}", "image/jpeg")
+
+
+def make_client() -> contextlib.AbstractAsyncContextManager:
+    from server import app
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+
+with open(IMAGE, "rb") as image_file:
+    image = image_file.read()
+
+
+@scenario
+async def create(client, total):
+    async def request(index):
+        response = await client.post("/memes?text=bench", files={"file": ("image.jpg", image, "image/jpeg")})
+        return response.status_code == 201
+    return request
+
+
+@scenario
+async def get(client, total):
+    async def request(index):
+        return (await client.get(f"/memes/{index % SEED + 1}")).status_code == 200
+    return request
+
+
+@scenario
+async def get_not_modified(client, total):
+    etags = [(await client.get(f"/memes/{meme_id}")).headers["etag"] for meme_id in range(1, SEED + 1)]
+
+    async def request(index):
+        response = await client.get(f"/memes/{index % SEED + 1}", headers={"If-None-Match": etags[index % SEED]})
+        return response.status_code == 304
+    return request
+
+
+@scenario
+async def get_missing(client, total):
+    async def request(index):
+        return (await client.get(f"/memes/{SEED * 10 + index}")).status_code == 404
+    return request
+
+
+@scenario
+async def list_offset(client, total):
+    async def request(index):
+        return (await client.get(f"/memes?offset={index % SEED}&limit=10")).status_code == 200
+    return request
+
+
+@scenario
+async def list_with_urls(client, total):
+    async def request(index):
+        return (await client.get("/memes?cursor=&limit=10&include_urls=true")).status_code == 200
+    return request
+
+
+@scenario
+async def update_text(client, total):
+    async def request(index):
+        return (await client.put(f"/memes/{index % SEED + 1}?text=updated")).status_code == 200
+    return request
+
+
+@scenario
+async def update_image(client, total):
+    async def request(index):
+        response = await client.put(f"/memes/{index % SEED + 1}",
+                                    files={"file": ("image.jpg", image, "image/jpeg")})
+        return response.status_code == 200
+    return request
+
+
+@scenario
+async def delete(client, total):
+    for index in range(total + SEED):
+        memes.add(f"victim{index}.jpg", str(uuid.uuid4()), "victim", "image/jpeg")
+    victims = itertools.count(SEED + 1)
+
+    async def request(index):
+        return (await client.delete(f"/memes/{next(victims)}")).status_code == 200
+    return request
+
+
+if __name__ == "__main__":
+    bench.main("bench_memes", list(SCENARIOS), __doc__)
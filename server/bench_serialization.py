@@ -0,0 +1,82 @@
+"""Cost of turning one page of memes into the response body, per page.
+
+Compares the default path, validation against the response_model and FastAPI's JSON encoder, with the
+FAST_RESPONSES path, plain dicts of the rows serialized by orjson. Both bodies are checked to be the same JSON.
+No database or media service is needed. Run inside the server container: python bench_serialization.py [pages]
+"""
+import asyncio
+import json
+import sys
+import time
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+from model import Meme
+from responses import meme_payload, fast_response
+from server import app
+from settings import service_settings
+
+PAGE_SIZES = (10, service_settings.PAGINATION_MAX_PER_PAGE)
+URL = "http://localhost:9000/memes-storage/{}?X-Amz-Algorithm=AWS4-HMAC-SHA256&X-Amz-Expires=604800&X-Amz-Signature={}"
+
+
+def response_field(path: str):
+    return next(route.response_field for route in app.routes if getattr(route, "path", None) == path
+                and "GET" in route.methods)
+
+
+def make_memes(count: int, with_urls: bool) -> list[Meme]:
+    memes = []
+    for meme_id in range(1, count + 1):
+        meme = Meme(meme_id=meme_id, text=f"meme number {meme_id} " * 8, file_name=f"image{meme_id}.jpg",
+                    new_file_name=f"{'0' * 64}.{meme_id}", mimetype="image/jpeg")
+        if with_urls:
+            meme.url = URL.format(meme.new_file_name, "f" * 64)
+        memes.append(meme)
+    return memes
+
+
+async def default_body(field, content) -> bytes:
+    return JSONResponse(await serialize_response(field=field, response_content=content)).body
+
+
+def fast_body(content) -> bytes:
+    return fast_response(content).body
+
+
+async def measure(field, memes: list[Meme], paged: bool, pages: int) -> tuple[float, float]:
+    def page(items):
+        return {"items": items, "next_cursor": "MTA"} if paged else items
+
+    default = await default_body(field, page(memes))
+    fast = fast_body(page([meme_payload(meme) for meme in memes]))
+    assert json.loads(default) == json.loads(fast), "the fast path changed the body"
+
+    started = time.perf_counter()
+    for _ in range(pages):
+        await default_body(field, page(memes))
+    default_time = (time.perf_counter() - started) / pages * 1e6
+
+    started = time.perf_counter()
+    for _ in range(pages):
+        fast_body(page([meme_payload(meme) for meme in memes]))
+    fast_time = (time.perf_counter() - started) / pages * 1e6
+    return default_time, fast_time
+
+
+async def main(pages: int):
+    field = response_field("/memes")
+    print(f"GET /memes, {pages} pages per case")
+    print(f"{'page':<26}{'default us':>12}{'fast us':>10}{'speedup':>9}")
+    for size in PAGE_SIZES:
+        for with_urls in (False, True):
+            for paged in (False, True):
+                memes = make_memes(size, with_urls)
+                default_time, fast_time = await measure(field, memes, paged, pages)
+                name = f"{size} memes{' +urls' if with_urls else ''}{' cursor' if paged else ''}"
+                print(f"{name:<26}{default_time:>12.1f}{fast_time:>10.1f}{default_time / fast_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
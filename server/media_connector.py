@@ -1,33 +1,218 @@
+import asyncio
+
 import httpx
 
-MEDIA_API_URL = f"http://media:8081"  # TODO: env settings
+import signer
+from cache import TTLCache
+from metrics import Counter, Gauge, Histogram, timed
+from settings import media_settings, storage_settings
+
+aclient: httpx.AsyncClient | None = None
+local = None  # media_local once open_media() has set up the in-process transport
+
+# Presigned urls stay valid for MEDIA_PRESIGNED_URL_EXPIRED_HOURS, cached ones are dropped long before that.
+url_cache = TTLCache(maxsize=media_settings.URL_CACHE_SIZE,
+                     ttl=min(media_settings.URL_CACHE_TTL,
+                             media_settings.MEDIA_PRESIGNED_URL_EXPIRED_HOURS * 60 * 60 // 2))
+
+media_call_duration = Histogram("media_call_duration_seconds", "Time spent in calls to the media service.",
+                                ("operation",))
+media_call_errors = Counter("media_call_errors_total", "Calls to the media service which raised an error.",
+                            ("operation",))
+media_responses = Counter("media_responses_total", "Responses of the media service.", ("method", "status"))
+upload_bytes_in_flight = Gauge("media_upload_bytes_in_flight", "Bytes of files being uploaded to the media service.")
+Gauge("url_cache_entries", "Presigned urls in the cache.", function=lambda: len(url_cache))
+Counter("url_cache_hits_total", "Lookups served from the presigned url cache.", function=lambda: url_cache.hits)
+Counter("url_cache_misses_total", "Lookups which missed the presigned url cache.", function=lambda: url_cache.misses)
+
+
+async def count_response(response: httpx.Response):
+    media_responses.inc(response.request.method, str(response.status_code))
+
+
+def open_client():
+    global aclient
+    if aclient is None or aclient.is_closed:
+        aclient = httpx.AsyncClient(
+            base_url=media_settings.MEDIA_API_URL,
+            limits=httpx.Limits(max_connections=media_settings.MEDIA_MAX_CONNECTIONS,
+                                max_keepalive_connections=media_settings.MEDIA_MAX_KEEPALIVE_CONNECTIONS,
+                                keepalive_expiry=media_settings.MEDIA_KEEPALIVE_EXPIRY),
+            timeout=media_settings.MEDIA_TIMEOUT,
+            http2=bool(media_settings.MEDIA_HTTP2),
+            event_hooks={"response": [count_response]},
+        )
+
+
+def get_client() -> httpx.AsyncClient:
+    """The client opened by open_media(). Its connections belong to the event loop of the lifespan,
+    so it is never created on the fly by a request."""
+    if aclient is None or aclient.is_closed:
+        raise RuntimeError("The media client is not open, open_media() has to be awaited first.")
+    return aclient
+
+
+async def close_client():
+    global aclient
+    if aclient is not None:
+        await aclient.aclose()
+        aclient = None
+
+
+async def open_media():
+    """Sets up the transport picked by MEDIA_TRANSPORT: http requests to the media service or in-process calls
+    of its storage layer."""
+    global local
+    if media_settings.MEDIA_TRANSPORT == "local":
+        import media_local
+        await media_local.start()
+        local = media_local
+    else:
+        open_client()
+
+
+async def close_media():
+    global local
+    if local is not None:
+        await local.stop()
+        local = None
+    await close_client()
 
-aclient = httpx.AsyncClient()
 
+async def fetch_file(filename: str) -> dict:
+    if local is not None:
+        return await local.download(filename)
+    response = await get_client().get(f"/{filename}")
+    return response.json()['detail'][0]
 
+
+@timed(media_call_duration, media_call_errors, "download")
 async def download_file(filename: str):
-    api_url = f"{MEDIA_API_URL}/{filename}"
-    async with httpx.AsyncClient() as client:
-        response = await client.get(api_url)
-        result = response.json()
+    """Urls of the file and its thumbnails. With local signing the media service is only asked whether the
+    file exists and its thumbnails are ready, until they are."""
+    cached = url_cache.get(filename)
+    if cached is not None and 'thumbnails' not in cached:
+        cached = None  # put there by download_files, which gets no thumbnails
+    if signer.enabled():
+        if cached is not None:
+            return signer.file_urls(filename, list(cached['thumbnails']), False)
+        if not signer.thumbnail_sizes() and not storage_settings.MINIO_STAT_ON_GET:
+            return signer.file_urls(filename, [], False)
+    elif cached is not None:
+        return cached
+
+    detail = await fetch_file(filename)
+    if 'url' in detail and not detail.get('thumbnails_pending'):
+        url_cache.set(filename, detail)
+    if signer.enabled() and 'url' in detail:
+        return signer.file_urls(filename, list(detail.get('thumbnails', {})), detail.get('thumbnails_pending', False))
+    return detail
+
+
+@timed(media_call_duration, media_call_errors, "presign")
+async def download_files(filenames: list[str]) -> dict:
+    """Download urls of many files: cached ones are reused and the rest are presigned in one media request.
+    With local signing every url is signed here and the request only checks files not seen before,
+    unless MINIO_STAT_ON_GET is off."""
+    signing = signer.enabled()
+    urls = {}
+    missing = []
+    for filename in filenames:
+        cached = url_cache.get(filename)
+        if cached is not None:
+            urls[filename] = signer.presign(signer.blob_key(filename)) if signing else cached['url']
+        elif signing and not storage_settings.MINIO_STAT_ON_GET:
+            urls[filename] = signer.presign(signer.blob_key(filename))
+        else:
+            missing.append(filename)
 
-        return result['detail'][0]
+    if missing:
+        if local is not None:
+            result = await local.presign(missing)
+        else:
+            response = await get_client().post("/presign", json={"file_names": missing})
+            result = response.json()['detail'][0]
+        for filename, url in result.get('urls', {}).items():
+            url_cache.set(filename, {"msg": "ok", "url": url})
+            urls[filename] = signer.presign(signer.blob_key(filename)) if signing else url
 
+    return urls
 
+
+@timed(media_call_duration, media_call_errors, "upload")
 async def upload_file(file):
-    api_url = MEDIA_API_URL
-    async with httpx.AsyncClient() as client:
-        response = await client.post(api_url, files={'file': file.file})
-        result = response.json()
+    size = file.size or 0
+    upload_bytes_in_flight.inc(value=size)
+    try:
+        if local is not None:
+            return await local.upload(file)
+        response = await get_client().post("/", files={'file': (file.filename, file.file, file.content_type)})
+    finally:
+        upload_bytes_in_flight.dec(value=size)
+    result = response.json()
 
-        return result['detail'][0]
+    return result['detail'][0]
 
 
-async def delete_file(filename: str) -> bool:
-    api_url = f"{MEDIA_API_URL}/{filename}"
-    async with httpx.AsyncClient() as client:
-        response = await client.delete(api_url)
-        result = response.json()
-        return result['detail'][0]['msg'] == "ok"
+@timed(media_call_duration, media_call_errors, "reserve_upload")
+async def reserve_upload(content_type: str, max_size: int, expires: int) -> dict:
+    """A new file name with the form which uploads it straight to the storage."""
+    if local is not None:
+        return await local.reserve_upload(content_type, max_size, expires)
+    response = await get_client().post("/uploads", json={"content_type": content_type, "max_size": max_size,
+                                                         "expires": expires})
+    return response.json()['detail'][0]
+
+
+@timed(media_call_duration, media_call_errors, "confirm_upload")
+async def confirm_upload(filename: str) -> dict | None:
+    """Size and sniffed content type of a file uploaded with a reserved form, None if it was not uploaded."""
+    if local is not None:
+        return await local.confirm_upload(filename)
+    response = await get_client().post("/uploads/confirm", json={"file_name": filename})
+    if response.status_code == 404:
+        return None
+    return response.json()['detail'][0]
 
 
+async def upload_files(files) -> list:
+    """Uploads files with at most MEDIA_UPLOAD_CONCURRENCY requests in flight.
+    The result of every file is either the media service answer or the exception raised for it."""
+    semaphore = asyncio.Semaphore(media_settings.MEDIA_UPLOAD_CONCURRENCY)
+
+    async def upload_limited(file):
+        async with semaphore:
+            return await upload_file(file)
+
+    return await asyncio.gather(*(upload_limited(file) for file in files), return_exceptions=True)
+
+
+@timed(media_call_duration, media_call_errors, "delete_many")
+async def delete_files(filenames: list[str]) -> list[str]:
+    """Removes files with batch delete requests of MEDIA_DELETE_BATCH_SIZE names.
+    Returns names which could not be removed."""
+    failed = []
+    step = media_settings.MEDIA_DELETE_BATCH_SIZE
+    for start in range(0, len(filenames), step):
+        chunk = filenames[start:start + step]
+        for filename in chunk:
+            url_cache.invalidate(filename)
+        if local is not None:
+            failed.extend(await local.delete_many(chunk))
+            continue
+        try:
+            response = await get_client().post("/delete", json={"file_names": chunk})
+            failed.extend(response.json()['detail'][0]['failed'])
+        except (httpx.HTTPError, KeyError, TypeError, ValueError):
+            failed.extend(chunk)
+    return failed
+
+
+@timed(media_call_duration, media_call_errors, "delete")
+async def delete_file(filename: str) -> bool:
+    url_cache.invalidate(filename)
+    if local is not None:
+        return (await local.delete(filename))['msg'] == "ok"
+    response = await get_client().delete(f"/{filename}")
+    result = response.json()
+    return result['detail'][0]['msg'] == "ok"
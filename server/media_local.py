@@ -0,0 +1,147 @@
+"""In-process transport of media_connector for deployments where this service runs next to the media service.
+The storage layer of the media service is imported from MEDIA_LOCAL_PATH and called directly, without HTTP and
+JSON. Answers have the shape of the details of the media API, so callers do not know which transport is used.
+Requires the packages of media/requirements.txt and the MINIO_* settings of the media service."""
+import importlib
+import importlib.abc
+import importlib.util
+import os
+import sys
+import types
+import uuid
+
+from settings import media_settings
+
+UNKNOWN_PROBLEM = {"msg": "Unknown exception during request processing."}
+NOT_EXISTS = {"msg": "File not exists"}
+PACKAGE = "media"
+COMMON_MODULES = frozenset({"bench", "metrics", "sniff"})  # copies of common/, one module for both services
+
+storage = None
+backend = None
+
+
+class MediaModuleFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Resolves the imports of the media modules among each other, e.g. `from settings import ...`,
+    to the modules of the package, so they are not mistaken for the modules of this service."""
+
+    def __init__(self, names):
+        self.names = names
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname in self.names:
+            return importlib.util.spec_from_loader(fullname, self)
+        return None
+
+    def create_module(self, spec):
+        return importlib.import_module(f"{PACKAGE}.{spec.name}")
+
+    def exec_module(self, module):
+        pass
+
+
+def import_media(name: str):
+    """Imports a module of the media service as media.<name>. While it runs, the names of the media modules are
+    taken from this service (settings, cache, responses...) and resolved within the package, afterwards they are
+    given back. Modules of common/ are shared."""
+    path = os.path.abspath(media_settings.MEDIA_LOCAL_PATH)
+    names = {file_name[:-3] for file_name in os.listdir(path) if file_name.endswith(".py")} - COMMON_MODULES
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [path]
+        sys.modules[PACKAGE] = package
+
+    own = {module_name: sys.modules.pop(module_name) for module_name in names if module_name in sys.modules}
+    finder = MediaModuleFinder(names)
+    sys.meta_path.insert(0, finder)
+    try:
+        return importlib.import_module(f"{PACKAGE}.{name}")
+    finally:
+        sys.meta_path.remove(finder)
+        for module_name in names:
+            sys.modules.pop(module_name, None)
+        sys.modules.update(own)
+
+
+async def start():
+    global storage, backend
+    if storage is None:
+        storage = import_media("storage")
+    backend = storage.get_storage()
+    await backend.start()
+
+
+async def stop():
+    global backend
+    if backend is not None:
+        await backend.stop()
+        import_media("thumbnails").stop_pool()
+        backend = None
+
+
+async def download(filename: str) -> dict:
+    """GET /{file_path} of the media service."""
+    try:
+        if storage.minio_config.MINIO_STAT_ON_GET and not await backend.check_file_name_exists(filename):
+            return NOT_EXISTS
+        url = await backend.get_object(filename)
+        thumbnails = await backend.get_thumbnails(filename)
+    except Exception:
+        return UNKNOWN_PROBLEM
+    return {"msg": "ok", "url": url, "thumbnails": thumbnails or {}, "thumbnails_pending": thumbnails is None}
+
+
+async def presign(filenames: list[str]) -> dict:
+    """POST /presign of the media service."""
+    try:
+        urls = await backend.get_objects(filenames, check_exists=bool(storage.minio_config.MINIO_STAT_ON_GET))
+    except Exception:
+        return UNKNOWN_PROBLEM
+    return {"msg": "ok", "urls": urls}
+
+
+async def upload(file) -> dict:
+    """POST / of the media service."""
+    try:
+        data_file = await backend.upload(file, str(uuid.uuid4()))
+    except Exception:
+        data_file = None
+    if data_file is None:
+        return UNKNOWN_PROBLEM
+    return {"msg": "File created", "deduplicated": False, **data_file}
+
+
+async def delete(filename: str) -> dict:
+    """DELETE /{file_path} of the media service."""
+    try:
+        if storage.minio_config.MINIO_STAT_ON_DELETE and not await backend.check_file_name_exists(filename):
+            return NOT_EXISTS
+        await backend.delete_object(filename)
+    except Exception:
+        return UNKNOWN_PROBLEM
+    return {"msg": "ok"}
+
+
+async def delete_many(filenames: list[str]) -> list[str]:
+    """POST /delete of the media service. Returns the names which could not be removed."""
+    try:
+        return await backend.delete_objects(filenames)
+    except Exception:
+        return filenames
+
+
+async def reserve_upload(content_type: str, max_size: int, expires: int) -> dict:
+    """POST /uploads of the media service."""
+    try:
+        return {"msg": "ok", **await backend.presigned_upload(str(uuid.uuid4()), content_type, max_size, expires)}
+    except Exception:
+        return UNKNOWN_PROBLEM
+
+
+async def confirm_upload(filename: str) -> dict | None:
+    """POST /uploads/confirm of the media service."""
+    try:
+        uploaded = await backend.confirm_upload(filename)
+    except Exception:
+        return UNKNOWN_PROBLEM
+    return {"msg": "ok", **uploaded} if uploaded is not None else None
@@ -0,0 +1,54 @@
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from responses import InvalidMediaFile
+from settings import service_settings
+
+MULTIPART_OVERHEAD = 64 * 1024  # boundaries, part headers and the text field around the image
+DEFAULT_BODY_LIMIT = 1024 * 1024
+
+
+def body_limit(method: str, path: str) -> int:
+    if method == "POST" and path == "/memes/batch":
+        return (service_settings.MAX_IMAGE_SIZE + MULTIPART_OVERHEAD) * service_settings.MEMES_BATCH_MAX_SIZE
+    if path.startswith("/memes/uploads"):
+        return DEFAULT_BODY_LIMIT  # the image goes straight to the storage
+    if method in ("POST", "PUT") and path.startswith("/memes"):
+        return service_settings.MAX_IMAGE_SIZE + MULTIPART_OVERHEAD
+    return DEFAULT_BODY_LIMIT
+
+
+def too_large(limit: int) -> InvalidMediaFile:
+    return InvalidMediaFile(msg=f"The request body should not exceed {limit // 1024}KB", input=limit // 1024)
+
+
+class BodySizeLimitMiddleware:
+    """Rejects oversized request bodies with 413 before they are spooled to disk.
+    A too large Content-Length is refused without reading the body at all, a chunked body is cut off
+    as soon as it crosses the limit."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        limit = body_limit(scope["method"], scope["path"])
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                response = JSONResponse(status_code=413, content={"detail": too_large(limit).details()})
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=too_large(limit).details())
+            return message
+
+        await self.app(scope, limited_receive, send)
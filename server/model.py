@@ -1,28 +1,266 @@
+import asyncio
+import re
+import time
+import uuid
+
+import asyncpg
 import sqlalchemy.exc
-from sqlalchemy import Column, Integer, VARCHAR, Text
+from sqlalchemy import Column, Integer, BigInteger, VARCHAR, Text, Computed, Index, Float, DateTime
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
-from sqlalchemy import select, update
+from sqlalchemy import (select, update, insert, delete, any_, bindparam, func, tuple_, literal, literal_column,
+                        cast, or_)
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR, insert as pg_insert
 
 from sqlalchemy.ext.asyncio import AsyncAttrs
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import event
+from sqlalchemy.orm import DeclarativeBase, Session, deferred
 
+from cache import TTLCache
+from metrics import Counter, Gauge, Histogram
 from settings import database_settings, service_settings
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
 
 
 class AsyncDeclarativeBase(AsyncAttrs, DeclarativeBase):
     pass
 
 
-postgres_url = "postgresql+asyncpg://{0}:{1}@db:{2}/{3}".format(database_settings.POSTGRES_USER,
-                                                                database_settings.POSTGRES_PASSWORD,
-                                                                database_settings.POSTGRES_PORT,
-                                                                database_settings.POSTGRES_DB)
+postgres_url = "postgresql+asyncpg://{0}:{1}@{2}:{3}/{4}?prepared_statement_cache_size={5}".format(
+    database_settings.POSTGRES_USER,
+    database_settings.POSTGRES_PASSWORD,
+    database_settings.POSTGRES_HOST,
+    database_settings.POSTGRES_PORT,
+    database_settings.POSTGRES_DB,
+    database_settings.DB_STATEMENT_CACHE_SIZE)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool which remembers how long callers waited for a connection."""
+    checkouts: int = 0
+    wait_time_total: float = 0.0
+    wait_time_max: float = 0.0
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return AsyncAdaptedQueuePool.connect(self)
+        finally:
+            waited = time.perf_counter() - started
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+
+def build_engine():
+    if not database_settings.DB_POOL_ENABLED:
+        return create_async_engine(postgres_url, poolclass=NullPool)
+
+    return create_async_engine(postgres_url,
+                               poolclass=TimedQueuePool,
+                               pool_size=database_settings.DB_POOL_SIZE,
+                               max_overflow=database_settings.DB_POOL_MAX_OVERFLOW,
+                               pool_timeout=database_settings.DB_POOL_TIMEOUT,
+                               pool_recycle=database_settings.DB_POOL_RECYCLE,
+                               pool_pre_ping=bool(database_settings.DB_POOL_PRE_PING))
+
 
-engine = create_async_engine(postgres_url, poolclass=NullPool)
+engine = build_engine()
 new_session = async_sessionmaker(engine, expire_on_commit=False)
 
+db_query_duration = Histogram("db_query_duration_seconds", "Time spent executing database statements.",
+                              ("statement",))
+db_query_errors = Counter("db_query_errors_total", "Database statements which raised an error.", ("statement",))
+db_sessions = Counter("db_sessions_total", "Database transactions started by sessions.")
+db_sessions_active = Gauge("db_sessions_active", "Sessions with an open database transaction.")
+STATEMENT_KIND = re.compile(r"\s*(\w+)")
+
+
+def statement_kind(statement: str) -> str:
+    match = STATEMENT_KIND.match(statement)
+    return match.group(1).upper() if match else "OTHER"
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def observe_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    db_query_duration.observe(time.perf_counter() - started, statement_kind(statement))
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def count_query_error(context):
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+    db_query_errors.inc(statement_kind(context.statement or ""))
+
+
+@event.listens_for(Session, "after_transaction_create")
+def count_session(session, transaction):
+    if transaction.parent is None:
+        db_sessions.inc()
+        db_sessions_active.inc()
+
+
+@event.listens_for(Session, "after_transaction_end")
+def release_session(session, transaction):
+    if transaction.parent is None:
+        db_sessions_active.dec()
+
+
+async def init_engine():
+    """Opens the first pooled connection, so the first request does not pay for the handshake."""
+    async with engine.connect():
+        pass
+
+
+async def dispose_engine():
+    await engine.dispose()
+
+
+# Rows of memes by meme_id. Other workers report their changes with NOTIFY on CHANGES_CHANNEL,
+# the cache is only used while this worker listens to them.
+meme_cache = TTLCache(maxsize=service_settings.MEME_CACHE_SIZE, ttl=service_settings.MEME_CACHE_TTL)
+MISSING = object()
+CHANGES_CHANNEL = f"{service_settings.DB_TABLE_NAME}_changes"
+cache_generation = 0  # incremented by every invalidation, so a row read before it is not cached after it
+listening = False
+listener: asyncio.Task | None = None
+
+
+Gauge("meme_cache_entries", "Memes and unknown ids in the meme cache.", function=lambda: len(meme_cache))
+Counter("meme_cache_hits_total", "Lookups served from the meme cache.", function=lambda: meme_cache.hits)
+Counter("meme_cache_misses_total", "Lookups which missed the meme cache.", function=lambda: meme_cache.misses)
+Counter("meme_cache_evictions_total", "Entries evicted to keep the meme cache bounded.",
+        function=lambda: meme_cache.evictions)
+
+
+def forget_memes(idents):
+    global cache_generation
+    cache_generation += 1
+    for ident in idents:
+        meme_cache.invalidate(ident)
+
+
+def on_change(connection, pid, channel, payload):
+    forget_memes(int(ident) for ident in payload.split(","))
+
+
+async def listen_changes():
+    global listening
+    while True:
+        try:
+            connection = await asyncpg.connect(host=database_settings.POSTGRES_HOST,
+                                               port=database_settings.POSTGRES_PORT,
+                                               user=database_settings.POSTGRES_USER,
+                                               password=database_settings.POSTGRES_PASSWORD,
+                                               database=database_settings.POSTGRES_DB)
+        except (OSError, asyncpg.PostgresError):
+            await asyncio.sleep(service_settings.MEME_CACHE_RECONNECT_DELAY)
+            continue
+
+        closed = asyncio.Event()
+        connection.add_termination_listener(lambda _: closed.set())
+        try:
+            await connection.add_listener(CHANGES_CHANNEL, on_change)
+            listening = True
+            await closed.wait()
+        finally:
+            # changes made while nobody listened are unknown
+            listening = False
+            forget_memes(())
+            meme_cache.clear()
+            if not connection.is_closed():
+                await connection.close()
+        await asyncio.sleep(service_settings.MEME_CACHE_RECONNECT_DELAY)
+
+
+def start_listener():
+    global listener
+    if service_settings.MEME_CACHE_SIZE > 0 and listener is None:
+        listener = asyncio.create_task(listen_changes())
+
+
+async def stop_listener():
+    global listener
+    if listener is not None:
+        listener.cancel()
+        try:
+            await listener
+        except asyncio.CancelledError:
+            pass
+        listener = None
+
+
+def get_meme_cache_stats() -> dict:
+    return {"listening": listening, **meme_cache.stats()}
+
+
+def notified(meme_id):
+    """pg_notify of a changed meme, delivered to the listening workers when the transaction commits."""
+    return func.pg_notify(CHANGES_CHANNEL, cast(meme_id, Text)).label("notified")
+
+
+def pool_stat(name):
+    return lambda: get_pool_stats().get(name, 0)
+
+
+Gauge("db_pool_checked_out", "Connections of the pool in use.", function=pool_stat("checked_out"))
+Gauge("db_pool_idle", "Idle connections of the pool.", function=pool_stat("idle"))
+Gauge("db_pool_overflow", "Connections opened above the pool size.", function=pool_stat("overflow"))
+Counter("db_pool_checkouts_total", "Connections taken from the pool.", function=pool_stat("checkouts"))
+Gauge("db_pool_wait_seconds_max", "Longest wait for a pool connection.", function=pool_stat("wait_time_max"))
+
+
+def get_pool_stats() -> dict:
+    pool = engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return {"pooled": False}
+
+    return {
+        "pooled": True,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "checkouts": pool.checkouts,
+        "wait_time_total": pool.wait_time_total,
+        "wait_time_avg": pool.wait_time_total / pool.checkouts if pool.checkouts else 0.0,
+        "wait_time_max": pool.wait_time_max,
+    }
+
+
+class TableVersion(AsyncDeclarativeBase):
+    """Change version of a table. It is incremented by the statements which change the table, in their
+    transaction, so every process sees the same version and a version is never newer than the data."""
+    __tablename__ = service_settings.VERSIONS_TABLE_NAME
+
+    table_name = Column(VARCHAR(length=64), primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+    @staticmethod
+    def bump(table_name, changed=None):
+        """INSERT ... ON CONFLICT DO UPDATE incrementing the version of table_name.
+        With changed, a CTE of a data-modifying statement, only if that statement touched any rows."""
+        row = select(literal(table_name, VARCHAR).label("table_name"), literal(1, BigInteger).label("version"))
+        if changed is not None:
+            row = row.where(select(changed).exists())
+        return (pg_insert(TableVersion.__table__)
+                .from_select(["table_name", "version"], row)
+                .on_conflict_do_update(index_elements=["table_name"],
+                                       set_={"version": TableVersion.__table__.c.version + 1}))
+
+    @staticmethod
+    async def get(table_name) -> int:
+        async with new_session() as session:
+            version = await session.scalar(select(TableVersion.version).where(TableVersion.table_name == table_name))
+            return version or 0
+
 
 class Meme(AsyncDeclarativeBase):
     __tablename__ = service_settings.DB_TABLE_NAME
@@ -32,14 +270,49 @@ class Meme(AsyncDeclarativeBase):
     new_file_name = Column(VARCHAR(length=service_settings.MAX_FILE_NAME_LENGTH), unique=True, nullable=False)
     file_name = Column(Text, nullable=False)
     mimetype = Column(VARCHAR(length=64), nullable=False)
+    # maintained by postgres, only used for filtering, so it is never loaded with the meme
+    search = deferred(Column(TSVECTOR, Computed(f"to_tsvector('{service_settings.SEARCH_TEXT_CONFIG}', text)",
+                                                persisted=True)))
+
+    __table_args__ = (
+        Index(f"ix_{service_settings.DB_TABLE_NAME}_search", "search", postgresql_using="gin"),
+    )
 
     @staticmethod
     async def create_meme(old_name, filename, text, mimetype):
-        meme = Meme(file_name=old_name, new_file_name=filename, text=text, mimetype=mimetype)
+        columns = [c for c in Meme.__table__.columns if c.computed is None]
+        created = (insert(Meme.__table__)
+                   .values(file_name=old_name, new_file_name=filename, text=text, mimetype=mimetype)
+                   .returning(*columns)
+                   .cte("created"))
+        bumped = TableVersion.bump(Meme.__tablename__).cte("bumped")
+        async with new_session() as session:
+            result = await session.execute(select(created, notified(created.c.meme_id)).add_cte(bumped))
+            row = result.mappings().one()
+            await session.commit()
+            forget_memes([row["meme_id"]])
+            return {c.name: str(row[c.name]) for c in columns}
+
+    @staticmethod
+    async def get_version() -> int:
+        """Change version of the memes table, incremented by every create, update and delete."""
+        return await TableVersion.get(Meme.__tablename__)
+
+    @staticmethod
+    async def create_memes(rows):
+        """Inserts all memes with one multi-row INSERT ... RETURNING, keeping the order of rows.
+        rows are dicts with old_name, filename, text and mimetype, like the arguments of create_meme."""
+        values = [dict(file_name=row["old_name"], new_file_name=row["filename"], text=row["text"],
+                       mimetype=row["mimetype"]) for row in rows]
         async with new_session() as session:
-            session.add(meme)
+            result = await session.scalars(insert(Meme).returning(Meme, sort_by_parameter_order=True), values)
+            memes = result.all()
+            idents = [meme.meme_id for meme in memes]
+            bumped = TableVersion.bump(Meme.__tablename__).cte("bumped")
+            await session.execute(select(notified(",".join(map(str, idents)))).add_cte(bumped))
             await session.commit()
-            return {c.name: str(getattr(meme, c.name)) for c in meme.__table__.columns}
+            forget_memes(idents)
+            return memes
 
     @staticmethod
     async def _get_meme(query):
@@ -52,37 +325,281 @@ class Meme(AsyncDeclarativeBase):
             return meme
 
     @staticmethod
-    async def delete_by_id(ident) -> bool:
+    async def _delete_where(condition):
+        """One DELETE ... RETURNING which also queues the images of the deleted memes in the storage deletion
+        outbox, so the memes and their pending image removals are committed together."""
+        columns = [c for c in Meme.__table__.columns if c.computed is None]
+        deleted = delete(Meme.__table__).where(condition).returning(*columns).cte("deleted")
+        queued = (insert(StorageDeletion.__table__)
+                  .from_select(["new_file_name"], select(deleted.c.new_file_name))
+                  .cte("queued"))
+        bumped = TableVersion.bump(Meme.__tablename__, deleted).cte("bumped")
         async with new_session() as session:
-            try:
-                meme = await session.get(Meme, ident)
-                await session.delete(meme)
-                await session.commit()
-                return True
-            except:
-                return False
+            result = await session.execute(select(deleted, notified(deleted.c.meme_id)).add_cte(queued, bumped))
+            rows = result.mappings().all()
+            await session.commit()
+            forget_memes(row["meme_id"] for row in rows)
+            return [Meme(**{c.name: row[c.name] for c in columns}) for row in rows]
+
+    @staticmethod
+    async def delete_by_id(ident):
+        """Returns the deleted meme or None if there was no such meme."""
+        memes = await Meme._delete_where(Meme.meme_id == ident)
+        return memes[0] if memes else None
+
+    @staticmethod
+    async def delete_by_ids(idents):
+        """Deletes all memes with meme_id = ANY(:ids). Returns the deleted memes."""
+        return await Meme._delete_where(Meme.meme_id == any_(bindparam("ids", list(idents), type_=ARRAY(Integer))))
 
     @staticmethod
     async def get_meme_by_id(ident):
         return await Meme._get_meme(select(Meme).filter(Meme.meme_id == ident))
 
+    @staticmethod
+    async def get_cached_by_id(ident):
+        """Read-through get_meme_by_id. Missing ids are cached for a shorter time.
+        Every call gets its own Meme, cached rows are never shared between requests."""
+        if not listening:
+            return await Meme.get_meme_by_id(ident)
+
+        values = meme_cache.get(ident)
+        if values is MISSING:
+            return None
+        if values is not None:
+            return Meme(**values)
+
+        generation = cache_generation
+        meme = await Meme.get_meme_by_id(ident)
+        if generation == cache_generation:
+            if meme is None:
+                meme_cache.set(ident, MISSING, ttl=service_settings.MEME_CACHE_NEGATIVE_TTL)
+            else:
+                meme_cache.set(ident, {c.name: getattr(meme, c.name)
+                                       for c in Meme.__table__.columns if c.computed is None})
+        return meme
+
     @staticmethod
     async def get_meme_by_filename(filename):
         return await Meme._get_meme(select(Meme).filter(Meme.new_file_name == filename))
 
     @staticmethod
     async def get_memes(offset, limit):
-        query = select(Meme).offset(offset).limit(limit)
+        query = select(Meme).order_by(Meme.meme_id).offset(offset).limit(limit)
         async with new_session() as session:
             result = await session.execute(query)
             memes = result.scalars().all()
             return memes
 
-    async def update(self, **kwargs):
-        query = update(Meme).filter(Meme.meme_id == self.meme_id).values(**kwargs)
+    @staticmethod
+    async def search_memes(text, limit, after=None):
+        """Full-text search over the GIN-indexed search column, best matches first.
+        after is the (rank, meme_id) of the last meme of the previous page."""
+        query_ts = func.websearch_to_tsquery(service_settings.SEARCH_TEXT_CONFIG, text)
+        rank = func.ts_rank(Meme.search, query_ts)
+        query = select(Meme, rank).filter(Meme.search.bool_op("@@")(query_ts))
+        if after is not None:
+            query = query.filter(tuple_(rank, Meme.meme_id) < tuple_(literal(after[0], Float), after[1]))
+        query = query.order_by(rank.desc(), Meme.meme_id.desc()).limit(limit + 1)
+        async with new_session() as session:
+            result = await session.execute(query)
+            rows = result.all()
+            return rows[:limit], len(rows) > limit
+
+    @staticmethod
+    async def get_memes_after(last_seen, limit):
+        """Keyset page: walks the primary key index, so the cost does not depend on the page number.
+        Returns the page and a flag telling whether there are more memes after it."""
+        query = select(Meme).filter(Meme.meme_id > last_seen).order_by(Meme.meme_id).limit(limit + 1)
+        async with new_session() as session:
+            result = await session.execute(query)
+            memes = result.scalars().all()
+            return memes[:limit], len(memes) > limit
+
+    @staticmethod
+    async def update_by_id(ident, **kwargs):
+        """One UPDATE ... FROM ... RETURNING. Returns the meme after the update and the new_file_name it had
+        before, or (None, None) if there was no such meme. Values equal to the current ones update nothing:
+        the version is not bumped and no change is notified then. A replaced image is queued in the storage
+        deletion outbox in the same statement."""
+        table = Meme.__table__
+        columns = [c for c in table.columns if c.computed is None]
+        # FOR UPDATE keeps a concurrent update from slipping in between reading the row and updating it
+        old = select(*columns).where(table.c.meme_id == ident).with_for_update().cte("old")
+        updated = (update(table)
+                   .where(table.c.meme_id == old.c.meme_id,
+                          or_(*(table.c[name].is_distinct_from(value) for name, value in kwargs.items())))
+                   .values(**kwargs)
+                   .returning(table.c.meme_id)
+                   .cte("updated"))
+        bumped = TableVersion.bump(Meme.__tablename__, updated).cte("bumped")
+        query = (select(old, updated.c.meme_id.label("updated"),
+                        select(notified(updated.c.meme_id)).scalar_subquery().label("notified"))
+                 .select_from(old.outerjoin(updated, updated.c.meme_id == old.c.meme_id))
+                 .add_cte(bumped))
+        if "new_file_name" in kwargs:
+            queued = (insert(StorageDeletion.__table__)
+                      .from_select(["new_file_name"],
+                                   select(old.c.new_file_name).join(updated, updated.c.meme_id == old.c.meme_id))
+                      .cte("queued"))
+            query = query.add_cte(queued)
+        async with new_session() as session:
+            result = await session.execute(query)
+            row = result.mappings().one_or_none()
+            await session.commit()
+            if row is None:
+                return None, None
+            values = {c.name: row[c.name] for c in columns}
+            if row["updated"] is not None:
+                values.update(kwargs)
+                forget_memes([ident])
+            return Meme(**values), row["new_file_name"]
+
+
+class StorageDeletion(AsyncDeclarativeBase):
+    """Outbox of images which are no longer referenced by any meme and wait to be removed from the storage."""
+    __tablename__ = service_settings.OUTBOX_TABLE_NAME
+
+    deletion_id = Column(Integer, primary_key=True)
+    new_file_name = Column(VARCHAR(length=service_settings.MAX_FILE_NAME_LENGTH), nullable=False)
+    attempts = Column(Integer, nullable=False, server_default="0")
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index(f"ix_{service_settings.OUTBOX_TABLE_NAME}_next_attempt_at", "next_attempt_at"),
+    )
+
+    @staticmethod
+    async def process_batch(limit, remove):
+        """Claims up to limit due deletions and awaits remove(file_names), which returns the names it could not
+        remove. Removed ones leave the outbox, failed ones are retried with exponential backoff.
+        Claiming moves next_attempt_at OUTBOX_LEASE ahead and commits, so no transaction stays open while the
+        files are removed; rows of a worker which died become due again when the lease runs out.
+        SKIP LOCKED lets several workers claim at once. Returns the number of claimed deletions."""
+        table = StorageDeletion.__table__
+        due = (select(table.c.deletion_id)
+               .where(table.c.next_attempt_at <= func.now())
+               .order_by(table.c.next_attempt_at)
+               .limit(limit)
+               .with_for_update(skip_locked=True))
+        claim = (update(table)
+                 .where(table.c.deletion_id.in_(due.scalar_subquery()))
+                 .values(next_attempt_at=func.now() + literal(service_settings.OUTBOX_LEASE, Float)
+                         * literal_column("interval '1 second'"))
+                 .returning(table.c.deletion_id, table.c.new_file_name))
+        async with new_session() as session:
+            rows = (await session.execute(claim)).all()
+            await session.commit()
+        if not rows:
+            return 0
+
+        failed = set(await remove(list(dict.fromkeys(row.new_file_name for row in rows))))
+        done = [row.deletion_id for row in rows if row.new_file_name not in failed]
+        retry = [row.deletion_id for row in rows if row.new_file_name in failed]
+
+        async with new_session() as session:
+            if done:
+                await session.execute(
+                    delete(table).where(table.c.deletion_id == any_(bindparam("done", done, type_=ARRAY(Integer)))))
+            if retry:
+                delay = func.least(literal(service_settings.OUTBOX_RETRY_BASE_DELAY, Float)
+                                   * func.power(literal(2.0, Float), table.c.attempts),
+                                   literal(service_settings.OUTBOX_RETRY_MAX_DELAY, Float))
+                await session.execute(
+                    update(table)
+                    .where(table.c.deletion_id == any_(bindparam("retry", retry, type_=ARRAY(Integer))))
+                    .values(attempts=table.c.attempts + 1,
+                            next_attempt_at=func.now() + delay * literal_column("interval '1 second'")))
+            await session.commit()
+        return len(rows)
+
+    @staticmethod
+    async def count():
+        async with new_session() as session:
+            return await session.scalar(select(func.count()).select_from(StorageDeletion.__table__))
+
+
+class MemeUpload(AsyncDeclarativeBase):
+    """Meme reserved by POST /memes/uploads. It becomes a meme once the client has uploaded the image straight
+    to the storage and confirmed it; reservations which are not confirmed expire and their images are removed."""
+    __tablename__ = service_settings.UPLOADS_TABLE_NAME
+
+    upload_id = Column(VARCHAR(length=36), primary_key=True)
+    text = Column(VARCHAR(length=service_settings.MAX_MEMES_TEXT_LENGTH), nullable=False)
+    file_name = Column(Text, nullable=False)
+    new_file_name = Column(VARCHAR(length=service_settings.MAX_FILE_NAME_LENGTH), unique=True, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index(f"ix_{service_settings.UPLOADS_TABLE_NAME}_expires_at", "expires_at"),
+    )
+
+    @staticmethod
+    async def create(text, old_name, filename, ttl):
+        """Reserves a meme for ttl seconds. Returns the reservation."""
+        values = dict(upload_id=str(uuid.uuid4()), text=text, file_name=old_name, new_file_name=filename,
+                      expires_at=func.now() + literal(ttl, Float) * literal_column("interval '1 second'"))
+        async with new_session() as session:
+            upload = await session.scalar(insert(MemeUpload).values(**values).returning(MemeUpload))
+            await session.commit()
+            return upload
+
+    @staticmethod
+    async def get(upload_id):
+        """The reservation, None if there is no such reservation or it has expired."""
+        table = MemeUpload.__table__
+        return await Meme._get_meme(select(MemeUpload).where(table.c.upload_id == upload_id,
+                                                             table.c.expires_at > func.now()))
+
+    @staticmethod
+    async def finalize(upload_id, mimetype):
+        """Turns the reservation into a meme with one DELETE ... RETURNING feeding an INSERT, so a reservation
+        confirmed twice at once makes one meme. Returns the meme, None if the reservation is gone."""
+        table = MemeUpload.__table__
+        columns = [c for c in Meme.__table__.columns if c.computed is None]
+        claimed = (delete(table)
+                   .where(table.c.upload_id == upload_id, table.c.expires_at > func.now())
+                   .returning(table.c.text, table.c.file_name, table.c.new_file_name)
+                   .cte("claimed"))
+        created = (insert(Meme.__table__)
+                   .from_select(["text", "file_name", "new_file_name", "mimetype"],
+                                select(claimed.c.text, claimed.c.file_name, claimed.c.new_file_name,
+                                       literal(mimetype, VARCHAR)))
+                   .returning(*columns)
+                   .cte("created"))
+        bumped = TableVersion.bump(Meme.__tablename__, created).cte("bumped")
         async with new_session() as session:
-            meme = await session.execute(query)
+            result = await session.execute(select(created, notified(created.c.meme_id)).add_cte(bumped))
+            row = result.mappings().one_or_none()
             await session.commit()
+            if row is None:
+                return None
+            forget_memes([row["meme_id"]])
+            return Meme(**{c.name: row[c.name] for c in columns})
+
+    @staticmethod
+    async def _drop_where(condition):
+        """Deletes reservations and queues their images in the storage deletion outbox in one statement.
+        Returns the number of dropped reservations."""
+        table = MemeUpload.__table__
+        dropped = delete(table).where(condition).returning(table.c.new_file_name).cte("dropped")
+        queued = (insert(StorageDeletion.__table__)
+                  .from_select(["new_file_name"], select(dropped.c.new_file_name))
+                  .cte("queued"))
+        async with new_session() as session:
+            dropped_count = await session.scalar(select(func.count()).select_from(dropped).add_cte(queued))
+            await session.commit()
+            return dropped_count
+
+    @staticmethod
+    async def reject(upload_id):
+        """Drops a reservation whose image did not pass validation."""
+        return await MemeUpload._drop_where(MemeUpload.__table__.c.upload_id == upload_id)
+
+    @staticmethod
+    async def expire():
+        """Drops the reservations which were not confirmed in time."""
+        return await MemeUpload._drop_where(MemeUpload.__table__.c.expires_at <= func.now())
 
 
 async def create_tables():
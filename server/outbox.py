@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+from media_connector import delete_files, open_media, close_media
+from metrics import Counter
+from model import StorageDeletion, MemeUpload, init_engine, dispose_engine
+from settings import service_settings
+
+worker: asyncio.Task | None = None
+wakeup: asyncio.Event | None = None
+stats = {"batches": 0, "removed": 0, "retried": 0, "errors": 0, "expired_uploads": 0, "last_error": None,
+         "last_run": None}
+
+Counter("outbox_removed_total", "Images removed from the storage by the outbox worker.",
+        function=lambda: stats["removed"])
+Counter("outbox_retried_total", "Image removals which failed and were scheduled for a retry.",
+        function=lambda: stats["retried"])
+Counter("outbox_errors_total", "Outbox worker runs which failed as a whole.", function=lambda: stats["errors"])
+Counter("outbox_expired_uploads_total", "Unconfirmed direct uploads whose images were queued for removal.",
+        function=lambda: stats["expired_uploads"])
+
+
+async def remove(file_names: list[str]) -> list[str]:
+    failed = await delete_files(file_names)
+    stats["removed"] += len(file_names) - len(failed)
+    stats["retried"] += len(failed)
+    return failed
+
+
+async def drain():
+    """Queues the images of expired upload reservations, then processes due deletions batch by batch
+    until a batch is not full."""
+    stats["expired_uploads"] += await MemeUpload.expire()
+    while True:
+        claimed = await StorageDeletion.process_batch(service_settings.OUTBOX_BATCH_SIZE, remove)
+        stats["batches"] += bool(claimed)
+        if claimed < service_settings.OUTBOX_BATCH_SIZE:
+            return
+
+
+def notify():
+    """Wakes the in-process worker up, so fresh deletions do not wait for the next poll."""
+    if wakeup is not None:
+        wakeup.set()
+
+
+async def run_worker():
+    global wakeup
+    wakeup = asyncio.Event()
+    while True:
+        wakeup.clear()
+        try:
+            await drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats["errors"] += 1
+            stats["last_error"] = repr(e)
+        stats["last_run"] = time.time()
+        try:
+            await asyncio.wait_for(wakeup.wait(), service_settings.OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_worker():
+    global worker
+    if service_settings.OUTBOX_WORKER_ENABLED and worker is None:
+        worker = asyncio.create_task(run_worker())
+
+
+async def stop_worker():
+    global worker
+    if worker is not None:
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+        worker = None
+
+
+async def main():
+    """Entry point for draining the outbox in a separate process: `python outbox.py`."""
+    await init_engine()
+    await open_media()
+    try:
+        await run_worker()
+    finally:
+        await close_media()
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,6 @@
+from datetime import datetime
+
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, PositiveInt, Field, HttpUrl
 from typing_extensions import TypedDict
 from settings import service_settings
@@ -10,24 +13,110 @@ class MemeInfo(BaseModel):
                                                                                                    "attached to the "
                                                                                                    "image.")
     file_name: str = Field(description="Name of the uploaded file. This name is differ from name in the storage.")
-    mimetype: str = Field(description="Mimetype of the image gotten from Content-Type header")
+    mimetype: str = Field(description="Mimetype of the image detected from its content")
 
 
 class MemeFullInfo(MemeInfo):
-    url: HttpUrl = Field(description="The link to the file in s3 storage, where this file can be downloaded.")
+    url: HttpUrl | None = Field(description="The link to the file in s3 storage, where this file can be downloaded. "
+                                            "null in a list when the image is missing from the storage.")
+    thumbnails: dict[str, HttpUrl] = Field(default_factory=dict,
+                                           description="Links to scaled down copies of the image by their size in "
+                                                       "pixels. Empty while the copies are being generated.")
+
+
+class MemesPage(BaseModel):
+    items: list[MemeFullInfo] | list[MemeInfo] = Field(description="Memes of the page ordered by meme_id.")
+    next_cursor: str | None = Field(description="Opaque cursor of the next page. null if this page is the last one.")
+
+
+def meme_payload(meme) -> dict:
+    """MemeInfo of a meme row as plain data, MemeFullInfo once a url is attached to it. Rows are not validated,
+    they met the constraints of the models on the way into the database."""
+    payload = {"meme_id": meme.meme_id, "text": meme.text, "file_name": meme.file_name, "mimetype": meme.mimetype}
+    if hasattr(meme, "url"):
+        payload["url"] = meme.url
+        payload["thumbnails"] = getattr(meme, "thumbnails", None) or {}
+    return payload
+
+
+def fast_response(content, etag: str | None = None) -> ORJSONResponse:
+    """Sends content serialized by orjson, past the response_model of the route. The ETag set by fresh_etag is
+    copied, FastAPI does not merge headers of the dependencies into a returned response."""
+    return ORJSONResponse(content, headers={"ETag": etag} if etag else None)
+
+
+class BatchItemResult(BaseModel):
+    index: int = Field(description="Position of the file in the request.")
+    status_code: int = Field(description="HTTP status the item would get from POST /memes.")
+    meme: MemeInfo | None = Field(None, description="Created meme. null if the item failed.")
+    detail: list[dict] | None = Field(None, description="Error of the item. null if the meme was created.")
+
+
+class BatchResult(BaseModel):
+    created: int = Field(description="Number of created memes.")
+    failed: int = Field(description="Number of items which failed.")
+    items: list[BatchItemResult] = Field(description="Results in the order of the uploaded files.")
+
+
+class BulkDeleteResult(BaseModel):
+    deleted: list[MemeInfo] = Field(description="Deleted memes.")
+    not_found: list[int] = Field(description="IDs which did not belong to any meme.")
+
+
+class UploadTicket(BaseModel):
+    upload_id: str = Field(description="ID of the reserved meme, confirm the upload with it.")
+    url: HttpUrl = Field(description="Where to send the image: a multipart/form-data POST with the fields, "
+                                     "followed by the image as the field named file.")
+    fields: dict[str, str] = Field(description="Form fields to send with the image, unchanged.")
+    expires_at: datetime = Field(description="The form is valid until then.")
+    confirm_before: datetime = Field(description="The reservation and the uploaded image are dropped if the "
+                                                 "upload is not confirmed by then.")
+
+
+class PoolStatus(BaseModel):
+    pooled: bool = Field(description="False if every session opens its own connection (NullPool).")
+    size: int | None = Field(None, description="Configured number of persistent connections.")
+    checked_out: int | None = Field(None, description="Connections currently in use.")
+    idle: int | None = Field(None, description="Connections currently waiting in the pool.")
+    overflow: int | None = Field(None, description="Connections opened above the pool size.")
+    checkouts: int | None = Field(None, description="Total number of connection checkouts.")
+    wait_time_total: float | None = Field(None, description="Total time spent waiting for a connection, seconds.")
+    wait_time_avg: float | None = Field(None, description="Average time spent waiting for a connection, seconds.")
+    wait_time_max: float | None = Field(None, description="Longest wait for a connection, seconds.")
+
+
+class CacheStatus(BaseModel):
+    size: int = Field(description="Number of cached entries.")
+    maxsize: int = Field(description="Maximum number of cached entries.")
+    hits: int = Field(description="Number of lookups served from the cache.")
+    misses: int = Field(description="Number of lookups which missed the cache.")
+    evictions: int = Field(description="Number of entries evicted to keep the cache bounded.")
+    hit_ratio: float = Field(description="Share of lookups served from the cache.")
+
+
+class MemeCacheStatus(CacheStatus):
+    listening: bool = Field(description="Whether changes made by other workers are delivered. "
+                                        "The cache is bypassed while they are not.")
+
+
+class OutboxStatus(BaseModel):
+    pending: int = Field(description="Number of images waiting to be removed from the s3 storage.")
+    batches: int = Field(description="Number of processed outbox batches.")
+    removed: int = Field(description="Number of images removed by the worker.")
+    retried: int = Field(description="Number of removals which failed and were scheduled for a retry.")
+    errors: int = Field(description="Number of worker runs which failed as a whole.")
+    expired_uploads: int = Field(description="Number of unconfirmed uploads whose images were queued for removal.")
+    last_error: str | None = Field(description="The last error of the worker.")
+    last_run: float | None = Field(description="Unix time of the last worker run.")
 
 
 class DefaultError(BaseModel):
-    detail: list[TypedDict("DefaultError", {"msg": str, "loc": list[int | str], "type": str, "input": str | int})] = [
-        {
-            "msg": "string",
-            "loc": list(),
-            "type": "error",
-            "input": ""
-        }, ]
+    detail: list[TypedDict("DefaultError", {"msg": str, "loc": list[int | str], "type": str, "input": str | int})] = \
+        Field(examples=[[{"msg": "string", "loc": [], "type": "error", "input": ""}]])
 
-    def __init__(self):
-        BaseModel.__init__(self)
+    def __init__(self, msg="string", loc=(), type="error", input=""):
+        # Built per instance: the payload ends up in the response and must not be shared between requests.
+        BaseModel.__init__(self, detail=[{"msg": msg, "loc": list(loc), "type": type, "input": input}])
 
     def details(self):
         return self.detail
@@ -36,26 +125,39 @@ class DefaultError(BaseModel):
 class MemeNotFound(DefaultError):
 
     def __init__(self, meme_id):
-        DefaultError.__init__(self)
-        self.detail[0]['loc'].extend(["path", "meme_id"])
-        self.detail[0]['msg'] = "The meme was not found or an incorrect id was passed."
-        self.detail[0]['input'] = meme_id
-        self.detail[0]['type'] = 'meme_not_found'
+        DefaultError.__init__(self, msg="The meme was not found or an incorrect id was passed.",
+                              loc=["path", "meme_id"], type='meme_not_found', input=meme_id)
 
 
 class InvalidMediaFile(DefaultError):
     def __init__(self, **kwargs):
-        DefaultError.__init__(self)
-        self.detail[0]['loc'].extend(["body", "file"])
-        self.detail[0]['msg'] = kwargs['msg']
-        self.detail[0]['input'] = kwargs['input']
-        self.detail[0]['type'] = 'image_validation_error'
+        DefaultError.__init__(self, msg=kwargs['msg'], loc=["body", "file"], type='image_validation_error',
+                              input=kwargs['input'])
 
 
 class ExternalServiceError(DefaultError):
     def __init__(self, msg):
-        DefaultError.__init__(self)
-        self.detail[0]['loc'].extend(["server"])
-        self.detail[0]['msg'] = msg
-        self.detail[0]['input'] = ""
-        self.detail[0]['type'] = 'external_server_error'
+        DefaultError.__init__(self, msg=msg, loc=["server"], type='external_server_error')
+
+
+class InvalidCursor(DefaultError):
+    def __init__(self, cursor):
+        DefaultError.__init__(self, msg="The cursor is malformed. Use next_cursor of the previous page.",
+                              loc=["query", "cursor"], type='invalid_cursor', input=cursor)
+
+
+class InvalidBatch(DefaultError):
+    def __init__(self, msg, input):
+        DefaultError.__init__(self, msg=msg, loc=["body", "texts"], type='batch_validation_error', input=input)
+
+
+class UploadNotFound(DefaultError):
+    def __init__(self, upload_id):
+        DefaultError.__init__(self, msg="The upload was not found, it has expired or was already confirmed.",
+                              loc=["path", "upload_id"], type='upload_not_found', input=upload_id)
+
+
+class UploadIncomplete(DefaultError):
+    def __init__(self, upload_id):
+        DefaultError.__init__(self, msg="The image has not been uploaded to the storage yet.",
+                              loc=["path", "upload_id"], type='upload_incomplete', input=upload_id)
@@ -1,21 +1,42 @@
-from fastapi import FastAPI, Query, UploadFile, HTTPException, status
+from fastapi import FastAPI, Query, Path, UploadFile, HTTPException, status, File, Form
+from fastapi.responses import Response
 from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 
-from model import Meme, create_tables, delete_tables
-from media_connector import upload_file, delete_file, download_file
+from model import (Meme, MemeUpload, StorageDeletion, create_tables, delete_tables, init_engine, dispose_engine,
+                   get_pool_stats, start_listener, stop_listener, get_meme_cache_stats)
+from media_connector import (upload_file, upload_files, delete_file, download_file, download_files,
+                             reserve_upload, confirm_upload, open_media, close_media, url_cache)
+from outbox import start_worker, stop_worker, notify, stats as outbox_stats
 
-from responses import MemeInfo, MemeFullInfo, MemeNotFound, InvalidMediaFile, ExternalServiceError
+from responses import (MemeInfo, MemeFullInfo, MemeNotFound, InvalidMediaFile, ExternalServiceError, PoolStatus,
+                       MemesPage, InvalidCursor, CacheStatus, BatchResult, InvalidBatch, BulkDeleteResult,
+                       OutboxStatus, MemeCacheStatus, UploadTicket, UploadNotFound, UploadIncomplete, meme_payload,
+                       fast_response)
 
-from validators import image_validator, valid_meme, image_validation_func
+from metrics import MetricsMiddleware, CONTENT_TYPE, render as render_metrics
+from middleware import BodySizeLimitMiddleware
+from validators import (image_validator, valid_meme, fresh_etag, image_validation_func, valid_cursor, encode_cursor,
+                        MemeIds, valid_search_cursor, encode_search_cursor, valid_upload_type,
+                        uploaded_image_validation)
 from settings import service_settings
-from typing import List
+from typing import List, Annotated
+from pydantic import StringConstraints
 
 
 @asynccontextmanager
 async def dev_lifespan(fap: FastAPI):
+    await init_engine()
+    await open_media()
     await create_tables()
+    start_listener()
+    start_worker()
     yield
+    await stop_worker()
+    await stop_listener()
     await delete_tables()
+    await close_media()
+    await dispose_engine()
 
 
 description = """
@@ -32,30 +53,97 @@ app = FastAPI(
                     "email": "klekks@ya.ru",
                 },
                 lifespan=dev_lifespan)
+app.add_middleware(BodySizeLimitMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get(
     "/memes",
-    response_model=List[MemeInfo],
+    response_model=List[MemeFullInfo] | List[MemeInfo] | MemesPage,
     status_code=status.HTTP_200_OK,
     summary="Get list of memes",
     tags=['meme', 'memes'],
     responses={
         status.HTTP_200_OK: {
-            "model": List[MemeInfo],
-            "description": "Success. meme_id and text of memes were returned."
+            "model": List[MemeFullInfo] | List[MemeInfo] | MemesPage,
+            "description": "Success. meme_id and text of memes were returned. "
+                           "With cursor the memes are wrapped in a page with next_cursor. "
+                           "With include_urls every meme also has its download url."
+        },
+        status.HTTP_304_NOT_MODIFIED: {
+            "description": "The memes have not changed since the ETag from If-None-Match was issued."
+        },
+        status.HTTP_422_UNPROCESSABLE_ENTITY: {
+            "model": InvalidCursor,
+            "description": "The cursor is malformed."
         },
         status.HTTP_500_INTERNAL_SERVER_ERROR: {
             "model": ExternalServiceError,
             "description": "An error occurred while connecting to an external service."
         }
     },
-    description="Endpoint for getting a list of available memes with pagination."
+    description="Endpoint for getting a list of available memes with pagination. "
+                "Offset pagination is used by default, pass cursor (empty for the first page) to use keyset "
+                "pagination, which is stable under concurrent inserts and as fast on deep pages as on the first one. "
+                "include_urls adds download urls to the memes, signed by this service or by the media service in one "
+                "request per page, url is null for a meme whose image is missing from the storage. "
+                "Responses have an ETag, send it back in If-None-Match to get 304 while the memes are unchanged."
 )
 async def get_memes(offset: int = Query(0, ge=0, title="Number of items will be skipped"),
                     limit: int = Query(10, ge=1, le=service_settings.PAGINATION_MAX_PER_PAGE,
-                                       title="Number of items on the page")):
-    return await Meme.get_memes(offset, limit)
+                                       title="Number of items on the page"),
+                    include_urls: bool = Query(False, title="Attach download urls to the memes"),
+                    last_seen: int | None = valid_cursor,
+                    etag: str = fresh_etag):
+    if last_seen is None:
+        memes, next_cursor = await Meme.get_memes(offset, limit), None
+    else:
+        memes, has_next = await Meme.get_memes_after(last_seen, limit)
+        next_cursor = encode_cursor(memes[-1].meme_id) if has_next else None
+
+    if include_urls and memes:
+        urls = await download_files([meme.new_file_name for meme in memes])
+        for meme in memes:
+            # a missing image leaves its meme without a url instead of failing the page
+            meme.url = urls.get(meme.new_file_name)
+
+    if service_settings.FAST_RESPONSES:
+        items = [meme_payload(meme) for meme in memes]
+        return fast_response(items if last_seen is None else {"items": items, "next_cursor": next_cursor}, etag)
+    if last_seen is None:
+        return memes
+    return {"items": memes, "next_cursor": next_cursor}
+
+
+@app.get(
+    "/memes/search",
+    response_model=MemesPage,
+    status_code=status.HTTP_200_OK,
+    summary="Search memes by text",
+    tags=['meme', 'memes'],
+    responses={
+        status.HTTP_200_OK: {
+            "model": MemesPage,
+            "description": "Success. Memes matching the query were returned, best matches first."
+        },
+        status.HTTP_422_UNPROCESSABLE_ENTITY: {
+            "model": InvalidCursor,
+            "description": "The cursor is malformed."
+        }
+    },
+    description="Endpoint for full-text search over the text of memes. Supports quoted phrases, OR and -word. "
+                "Pages are fetched with next_cursor of the previous page."
+)
+async def search_memes(q: str = Query(min_length=1, max_length=service_settings.MAX_SEARCH_QUERY_LENGTH,
+                                      description="Words to look for in the text of memes."),
+                       limit: int = Query(10, ge=1, le=service_settings.PAGINATION_MAX_PER_PAGE,
+                                          title="Number of items on the page"),
+                       after: tuple[float, int] | None = valid_search_cursor):
+    rows, has_next = await Meme.search_memes(q, limit, after)
+    next_cursor = encode_search_cursor(rows[-1][1], rows[-1][0].meme_id) if has_next else None
+    if service_settings.FAST_RESPONSES:
+        return fast_response({"items": [meme_payload(meme) for meme, _ in rows], "next_cursor": next_cursor})
+    return {"items": [meme for meme, _ in rows], "next_cursor": next_cursor}
 
 
 @app.get(
@@ -69,6 +157,9 @@ async def get_memes(offset: int = Query(0, ge=0, title="Number of items will be
             "model": MemeInfo,
             "description": "Success. meme_id and text were returned."
         },
+        status.HTTP_304_NOT_MODIFIED: {
+            "description": "The meme has not changed since the ETag from If-None-Match was issued."
+        },
         status.HTTP_404_NOT_FOUND: {
             "model": MemeNotFound,
             "description": "Meme was not found.",
@@ -78,13 +169,16 @@ async def get_memes(offset: int = Query(0, ge=0, title="Number of items will be
             "description": "An error occurred while connecting to an external service."
         }
     })
-async def get_meme_by_id(meme: Meme = valid_meme):
+async def get_meme_by_id(meme: Meme = valid_meme, etag: str = fresh_etag):
     meme_info = await download_file(meme.new_file_name)
     if 'url' not in meme_info:
         raise HTTPException(status_code=500,
                             detail=ExternalServiceError("Error extracting from s3 storage.").details())
 
-    meme.url = meme_info['url'].replace("storage", "localhost", 1)  # TODO: MINIO hates changing domain name
+    meme.url = meme_info['url']
+    meme.thumbnails = meme_info.get('thumbnails', {})
+    if service_settings.FAST_RESPONSES:
+        return fast_response(meme_payload(meme), etag)
     return meme
 
 
@@ -128,6 +222,211 @@ async def add_new_meme(file: image_validator,
     return await Meme.create_meme(file.filename, filename, text, file.content_type)
 
 
+@app.post(
+    "/memes/batch",
+    response_model=BatchResult,
+    status_code=status.HTTP_200_OK,
+    summary="Create many memes in one request",
+    tags=['meme', 'memes'],
+    responses={
+        status.HTTP_200_OK: {
+            "model": BatchResult,
+            "description": "Request processed. Every item has its own status, failed items have an error."
+        },
+        status.HTTP_422_UNPROCESSABLE_ENTITY: {
+            "model": InvalidBatch,
+            "description": "The number of texts differs from the number of files or the batch is too large."
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "model": ExternalServiceError,
+            "description": "An error occurred while connecting to an external service."
+        }
+    },
+    description="Endpoint for importing memes. Takes files and texts as form fields, the n-th text describes "
+                "the n-th file. All files are validated first, valid ones are uploaded concurrently and saved "
+                "with one insert."
+)
+async def add_new_memes(files: List[UploadFile] = File(description="Images of the memes."),
+                        texts: List[Annotated[str, StringConstraints(
+                            min_length=1, max_length=service_settings.MAX_MEMES_TEXT_LENGTH)]] = Form(
+                            description="Descriptions of the memes, one per file.")):
+    if len(files) != len(texts):
+        raise HTTPException(status_code=422,
+                            detail=InvalidBatch("The number of texts should be equal to the number of files.",
+                                                len(texts)).details())
+    if len(files) > service_settings.MEMES_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=422,
+                            detail=InvalidBatch(f"The batch should not contain more than "
+                                                f"{service_settings.MEMES_BATCH_MAX_SIZE} memes.",
+                                                len(files)).details())
+
+    results = [{"index": index, "status_code": status.HTTP_201_CREATED} for index in range(len(files))]
+    valid = []
+    for index, file in enumerate(files):
+        try:
+            image_validation_func(file)
+            valid.append(index)
+        except HTTPException as e:
+            results[index].update(status_code=e.status_code, detail=e.detail)
+
+    rows = []
+    for index, upload_result in zip(valid, await upload_files([files[index] for index in valid])):
+        if isinstance(upload_result, dict) and "file_name" in upload_result:
+            rows.append((index, {"old_name": files[index].filename, "filename": upload_result["file_name"],
+                                 "text": texts[index], "mimetype": files[index].content_type}))
+        else:
+            results[index].update(status_code=500,
+                                  detail=ExternalServiceError("Error uploading to s3 storage.").details())
+
+    if rows:
+        try:
+            memes = await Meme.create_memes([row for _, row in rows])
+        except Exception:
+            for _, row in rows:
+                await delete_file(row["filename"])
+            raise HTTPException(status_code=500,
+                                detail=ExternalServiceError("Error saving memes to the database.").details())
+        for (index, _), meme in zip(rows, memes):
+            results[index]["meme"] = meme
+
+    created = sum(1 for result in results if "meme" in result)
+    return {"created": created, "failed": len(results) - created, "items": results}
+
+
+@app.post(
+    "/memes/uploads",
+    response_model=UploadTicket,
+    status_code=status.HTTP_201_CREATED,
+    summary="Reserve a meme and get a form for uploading its image to the storage",
+    tags=['meme'],
+    responses={
+        status.HTTP_201_CREATED: {
+            "model": UploadTicket,
+            "description": "Meme reserved. The image should be posted to url with the fields."
+        },
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE: {
+            "model": InvalidMediaFile,
+            "description": "The content type is not an image or this type of image is not supported."
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "model": ExternalServiceError,
+            "description": "An error occurred while connecting to an external service."
+        }
+    },
+    description="First step of an upload which does not pass through this service. The image is posted by the "
+                "client straight to the s3 storage, which enforces the size limit and the declared content type. "
+                "The meme is created by POST /memes/uploads/{upload_id}/confirm."
+)
+async def reserve_meme(content_type: str = valid_upload_type,
+                       file_name: str = Query(min_length=1, max_length=255, description="Name of the image file."),
+                       text: str = Query(min_length=1,
+                                         max_length=service_settings.MAX_MEMES_TEXT_LENGTH,
+                                         description="Description of the meme. It will be attached to the image.")):
+    form = await reserve_upload(content_type, service_settings.MAX_IMAGE_SIZE, service_settings.DIRECT_UPLOAD_URL_TTL)
+    if "file_name" not in form:
+        raise HTTPException(status_code=500,
+                            detail=ExternalServiceError("Error reserving an upload in s3 storage.").details())
+
+    upload = await MemeUpload.create(text, file_name, form["file_name"], service_settings.DIRECT_UPLOAD_CONFIRM_TTL)
+    return {
+        "upload_id": upload.upload_id,
+        "url": form["url"],
+        "fields": form["fields"],
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=service_settings.DIRECT_UPLOAD_URL_TTL),
+        "confirm_before": upload.expires_at,
+    }
+
+
+@app.post(
+    "/memes/uploads/{upload_id}/confirm",
+    response_model=MemeInfo,
+    status_code=status.HTTP_201_CREATED,
+    summary="Create the reserved meme from its uploaded image",
+    tags=['meme'],
+    responses={
+        status.HTTP_201_CREATED: {
+            "model": MemeInfo,
+            "description": "Meme created successful. meme_id and text were returned."
+        },
+        status.HTTP_404_NOT_FOUND: {
+            "model": UploadNotFound,
+            "description": "There is no such reservation, it has expired or was already confirmed."
+        },
+        status.HTTP_409_CONFLICT: {
+            "model": UploadIncomplete,
+            "description": "The image is not in the storage yet. The reservation is kept, confirm again later."
+        },
+        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE: {
+            "model": InvalidMediaFile,
+            "description": "The maximum allowed image size has been exceeded. The reservation is dropped."
+        },
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE: {
+            "model": InvalidMediaFile,
+            "description": "The uploaded file is not an image or this type of image is not supported. "
+                           "The reservation is dropped."
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "model": ExternalServiceError,
+            "description": "An error occurred while connecting to an external service."
+        }
+    },
+    description="Second step of a direct upload. The image is checked in the storage by its size and its first "
+                "bytes, like an image posted to POST /memes, and the reservation becomes a meme."
+)
+async def confirm_meme(upload_id: str = Path(max_length=36)):
+    upload = await MemeUpload.get(upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail=UploadNotFound(upload_id).details())
+
+    uploaded = await confirm_upload(upload.new_file_name)
+    if uploaded is None:
+        raise HTTPException(status_code=409, detail=UploadIncomplete(upload_id).details())
+    if "size" not in uploaded:
+        raise HTTPException(status_code=500,
+                            detail=ExternalServiceError("Error checking the upload in s3 storage.").details())
+
+    try:
+        mimetype = uploaded_image_validation(uploaded)
+    except HTTPException:
+        await MemeUpload.reject(upload_id)
+        notify()
+        raise
+
+    meme = await MemeUpload.finalize(upload_id, mimetype)
+    if meme is None:
+        raise HTTPException(status_code=404, detail=UploadNotFound(upload_id).details())
+    return meme
+
+
+@app.delete(
+    "/memes",
+    response_model=BulkDeleteResult,
+    status_code=status.HTTP_200_OK,
+    summary="Delete many memes",
+    tags=['meme', 'memes'],
+    responses={
+        status.HTTP_200_OK: {
+            "model": BulkDeleteResult,
+            "description": "Memes deleted. Unknown ids are reported."
+        }
+    },
+    description="Endpoint for moderation cleanups. Takes list of meme ids as body, removes the memes with one "
+                "query. Their images are removed from the s3 storage in the background."
+)
+async def delete_many_memes(body: MemeIds):
+    memes = await Meme.delete_by_ids(set(body.meme_ids))
+    for meme in memes:
+        url_cache.invalidate(meme.new_file_name)
+    if memes:
+        notify()
+
+    deleted_ids = {meme.meme_id for meme in memes}
+    return {
+        "deleted": memes,
+        "not_found": [meme_id for meme_id in dict.fromkeys(body.meme_ids) if meme_id not in deleted_ids],
+    }
+
+
 @app.delete(
     "/memes/{meme_id}",
     response_model=MemeInfo,
@@ -142,20 +441,17 @@ async def add_new_meme(file: image_validator,
         status.HTTP_404_NOT_FOUND: {
             "model": MemeNotFound,
             "description": "Meme was not found.",
-        },
-        status.HTTP_500_INTERNAL_SERVER_ERROR: {
-            "model": ExternalServiceError,
-            "description": "An error occurred while connecting to an external service."
         }
-    })
-async def delete_memes(meme: Meme = valid_meme):
-    is_deleted = await Meme.delete_by_id(meme.meme_id)
-
-    if is_deleted and (await delete_file(meme.new_file_name)):
-        return meme
+    },
+    description="Endpoint for removing a meme. The image is removed from the s3 storage in the background.")
+async def delete_memes(meme_id: int):
+    meme = await Meme.delete_by_id(meme_id)
+    if meme is None:
+        raise HTTPException(status_code=404, detail=MemeNotFound(meme_id).details())
 
-    raise HTTPException(status_code=500,
-                        detail=ExternalServiceError("Error deleting from s3 storage.").details())
+    url_cache.invalidate(meme.new_file_name)
+    notify()
+    return meme
 
 
 @app.put(
@@ -186,18 +482,99 @@ async def delete_memes(meme: Meme = valid_meme):
             "description": "An error occurred while connecting to an external service."
         }
     })
-async def update_memes(file: UploadFile = None,
-                       meme: Meme = valid_meme,
+async def update_memes(meme_id: int,
+                       file: UploadFile = None,
                        text: str = Query(None, min_length=1, max_length=256, title="New description of the meme")):
-    if text is not None and meme.text != text:
-        await meme.update(text=text)
+    values = {}
+    if text is not None:
+        values.update(text=text)
 
     if file is not None:
+        # an unknown id must not cost an upload, and answers 404 whatever the file is
+        if await Meme.get_cached_by_id(meme_id) is None:
+            raise HTTPException(status_code=404, detail=MemeNotFound(meme_id).details())
         image_validation_func(file)
         upload_result = await upload_file(file)
         if 'file_name' not in upload_result:
             raise HTTPException(status_code=500,
                                 detail=ExternalServiceError("Error uploading to s3 storage.").details())
-        await meme.update(file_name=upload_result['file_name'])
+        values.update(file_name=file.filename, new_file_name=upload_result['file_name'], mimetype=file.content_type)
+
+    if not values:
+        meme, old_file_name = await Meme.get_meme_by_id(meme_id), None
+    else:
+        meme, old_file_name = await Meme.update_by_id(meme_id, **values)
+
+    if meme is None:
+        if file is not None:
+            await delete_file(values['new_file_name'])
+        raise HTTPException(status_code=404, detail=MemeNotFound(meme_id).details())
+
+    if file is not None:
+        url_cache.invalidate(old_file_name)
+        notify()
+    return meme
+
 
-    return await Meme.get_meme_by_id(meme.meme_id)
+@app.get(
+    "/status/db-pool",
+    response_model=PoolStatus,
+    status_code=status.HTTP_200_OK,
+    summary="Get database connection pool statistics",
+    tags=['status'],
+    description="Endpoint for sizing the database connection pool: checked-out and idle connections, wait time."
+)
+async def get_db_pool_status():
+    return get_pool_stats()
+
+
+@app.get(
+    "/status/url-cache",
+    response_model=CacheStatus,
+    status_code=status.HTTP_200_OK,
+    summary="Get presigned url cache statistics",
+    tags=['status'],
+    description="Endpoint for monitoring the cache of download urls: size, hits, misses and evictions."
+)
+async def get_url_cache_status():
+    return url_cache.stats()
+
+
+@app.get(
+    "/status/meme-cache",
+    response_model=MemeCacheStatus,
+    status_code=status.HTTP_200_OK,
+    summary="Get meme row cache statistics",
+    tags=['status'],
+    description="Endpoint for monitoring the cache of memes looked up by meme_id, including unknown ids: "
+                "size, hit ratio, evictions and whether changes of other workers are delivered to it."
+)
+async def get_meme_cache_status():
+    return get_meme_cache_stats()
+
+
+@app.get(
+    "/status/outbox",
+    response_model=OutboxStatus,
+    status_code=status.HTTP_200_OK,
+    summary="Get storage deletion outbox statistics",
+    tags=['status'],
+    description="Endpoint for monitoring the background removal of images: pending removals, retries, errors. "
+                "Worker counters are per process, they stay zero when the outbox is drained by `python outbox.py`."
+)
+async def get_outbox_status():
+    return {"pending": await StorageDeletion.count(), **outbox_stats}
+
+
+@app.get(
+    "/metrics",
+    status_code=status.HTTP_200_OK,
+    summary="Get metrics in the Prometheus text format",
+    tags=['status'],
+    response_class=Response,
+    description="Endpoint for scraping: request latency and status counts per route, database statements and "
+                "sessions, media service calls, caches and the storage deletion outbox. "
+                "Every worker process has its own metrics."
+)
+async def get_metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
@@ -5,9 +5,29 @@ class ServiceSettings(BaseSettings):
     MAX_IMAGE_SIZE: int = 8 * 1024 * 1024  # in bytes
     ALLOWED_IMAGE_TYPES: str = "png,jpeg,gif,apng"
     PAGINATION_MAX_PER_PAGE: int = 50
+    MEMES_BATCH_MAX_SIZE: int = 100
+    MEMES_DELETE_BATCH_MAX_SIZE: int = 10000
     MAX_MEMES_TEXT_LENGTH: int = 256
     DB_TABLE_NAME: str = "Memes"
-    MAX_FILE_NAME_LENGTH: int = 36  # (UUID -> str) has length equal 36
+    MAX_FILE_NAME_LENGTH: int = 128  # sha256 hex (64) + "." + UUID (36); plain UUID names are 36
+    SEARCH_TEXT_CONFIG: str = "simple"  # postgres text search configuration of the meme text
+    MAX_SEARCH_QUERY_LENGTH: int = 256
+    FAST_RESPONSES: int = 0  # 1 -> hot GET routes skip response validation, requires the optional `orjson` package
+    MEME_CACHE_SIZE: int = 10000  # 0 disables the cache of meme rows
+    MEME_CACHE_TTL: float = 60.0  # in seconds
+    MEME_CACHE_NEGATIVE_TTL: float = 5.0  # in seconds, for ids which do not exist
+    MEME_CACHE_RECONNECT_DELAY: float = 5.0  # in seconds, between attempts to listen for changes
+    VERSIONS_TABLE_NAME: str = "TableVersions"  # change versions of tables, used for ETags
+    OUTBOX_TABLE_NAME: str = "StorageDeletions"
+    UPLOADS_TABLE_NAME: str = "MemeUploads"  # memes reserved by POST /memes/uploads
+    DIRECT_UPLOAD_URL_TTL: int = 15 * 60  # in seconds, validity of the upload form
+    DIRECT_UPLOAD_CONFIRM_TTL: int = 60 * 60  # in seconds, longer than the form; unconfirmed images are removed then
+    OUTBOX_WORKER_ENABLED: int = 1  # 0 -> the outbox is drained by a separate `python outbox.py` process
+    OUTBOX_BATCH_SIZE: int = 100  # file names removed with one media request
+    OUTBOX_POLL_INTERVAL: float = 5.0  # in seconds
+    OUTBOX_RETRY_BASE_DELAY: float = 1.0  # in seconds, doubled after every failed attempt
+    OUTBOX_RETRY_MAX_DELAY: float = 10 * 60.0  # in seconds
+    OUTBOX_LEASE: float = 60.0  # in seconds a worker has for a claimed batch before others may claim it again
 
 
 class DatabaseSettings(BaseSettings):
@@ -15,8 +35,45 @@ class DatabaseSettings(BaseSettings):
     POSTGRES_PASSWORD: str
     POSTGRES_DB: str
     PGDATA: str
+    POSTGRES_HOST: str = "db"
     POSTGRES_PORT: int = 5432
+    DB_POOL_ENABLED: int = 1  # 0 -> NullPool, a fresh connection for every session
+    DB_POOL_SIZE: int = 10
+    DB_POOL_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: int = 30  # in seconds
+    DB_POOL_RECYCLE: int = 30 * 60  # in seconds
+    DB_POOL_PRE_PING: int = 1
+    DB_STATEMENT_CACHE_SIZE: int = 100  # asyncpg prepared statements per connection
+
+
+class MediaServiceSettings(BaseSettings):
+    MEDIA_TRANSPORT: str = "http"  # http | local: call the storage layer of the media service in this process
+    MEDIA_LOCAL_PATH: str = "../media"  # sources of the media service for the local transport
+    MEDIA_API_URL: str = "http://media:8081"
+    MEDIA_MAX_CONNECTIONS: int = 100
+    MEDIA_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    MEDIA_KEEPALIVE_EXPIRY: float = 30.0  # in seconds
+    MEDIA_TIMEOUT: float = 10.0  # in seconds
+    MEDIA_HTTP2: int = 0  # requires the optional `h2` package
+    MEDIA_UPLOAD_CONCURRENCY: int = 8  # parallel uploads of one batch request
+    MEDIA_DELETE_BATCH_SIZE: int = 1000  # object names per media batch delete request
+    MEDIA_PRESIGNED_URL_EXPIRED_HOURS: int = 7 * 24  # must match the media service
+    URL_CACHE_SIZE: int = 10000  # 0 disables the presigned url cache
+    URL_CACHE_TTL: int = 24 * 60 * 60  # in seconds, must be well below the url expiration
+
+
+class StorageSettings(BaseSettings):
+    MINIO_ROOT_USER: str = ""  # with the password, download urls are signed here instead of by the media service
+    MINIO_ROOT_PASSWORD: str = ""
+    MINIO_SIGN_LOCALLY: int = 0  # 1 -> sign download urls here, only for MINIO_STORAGE_BACKEND=minio of media
+    MINIO_STAT_ON_GET: int = 1  # must match the media service, unknown files are checked by it when signing
+    MINIO_PUBLIC_URL: str = "http://localhost:9000"  # the storage as seen by clients, must match the media service
+    MINIO_BUCKET_NAME: str = "memes-storage"  # must match the media service
+    MINIO_REGION: str = "us-east-1"
+    MINIO_THUMBNAIL_SIZES: str = "128,256,512"  # must match the media service
 
 
 database_settings = DatabaseSettings()
 service_settings = ServiceSettings()
+media_settings = MediaServiceSettings()
+storage_settings = StorageSettings()
@@ -0,0 +1,73 @@
+"""SigV4 presigned download urls of the storage, computed in this service instead of asking the media service:
+a presigned url is a few HMACs over the object key. The keys follow the layout of media/storage.py,
+deduplicated content is stored under sha256/<digest> and thumbnails next to it."""
+import functools
+import hashlib
+import hmac
+import time
+from urllib.parse import quote, urlsplit
+
+from settings import storage_settings, media_settings
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+# Urls are signed at the start of a period, so a file keeps the same url for the period and clients can cache
+# the image. Every url is still valid for at least the expiration minus one period.
+SIGNING_PERIOD = min(media_settings.URL_CACHE_TTL, media_settings.MEDIA_PRESIGNED_URL_EXPIRED_HOURS * 60 * 60 // 2)
+
+
+def enabled() -> bool:
+    return bool(storage_settings.MINIO_SIGN_LOCALLY and storage_settings.MINIO_ROOT_USER
+                and storage_settings.MINIO_ROOT_PASSWORD)
+
+
+def thumbnail_sizes() -> list[int]:
+    return sorted(int(size) for size in storage_settings.MINIO_THUMBNAIL_SIZES.split(",") if size.strip())
+
+
+def blob_key(file_name: str) -> str:
+    digest, separator, _ = file_name.partition(".")
+    return f"sha256/{digest}" if separator else file_name
+
+
+def thumbnail_key(file_name: str, size: int) -> str:
+    return f"{blob_key(file_name)}@{size}"
+
+
+@functools.lru_cache(maxsize=4)
+def signing_key(secret_key: str, datestamp: str, region: str) -> bytes:
+    key = f"AWS4{secret_key}".encode()
+    for part in (datestamp, region, "s3", "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+
+def presign(key: str, signed_at: float | None = None) -> str:
+    """Presigned GET url of the object under MINIO_PUBLIC_URL, valid for MEDIA_PRESIGNED_URL_EXPIRED_HOURS."""
+    if signed_at is None:
+        now = int(time.time())
+        signed_at = now - now % SIGNING_PERIOD
+    amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(signed_at))
+    scope = f"{amz_date[:8]}/{storage_settings.MINIO_REGION}/s3/aws4_request"
+
+    endpoint = urlsplit(storage_settings.MINIO_PUBLIC_URL)
+    path = quote(f"{endpoint.path.rstrip('/')}/{storage_settings.MINIO_BUCKET_NAME}/{key}", safe="/~")
+    query = "&".join(f"{name}={quote(value, safe='~')}" for name, value in (
+        ("X-Amz-Algorithm", ALGORITHM),
+        ("X-Amz-Credential", f"{storage_settings.MINIO_ROOT_USER}/{scope}"),
+        ("X-Amz-Date", amz_date),
+        ("X-Amz-Expires", str(media_settings.MEDIA_PRESIGNED_URL_EXPIRED_HOURS * 60 * 60)),
+        ("X-Amz-SignedHeaders", "host"),
+    ))
+    canonical_request = f"GET\n{path}\n{query}\nhost:{endpoint.netloc}\n\nhost\nUNSIGNED-PAYLOAD"
+    string_to_sign = f"{ALGORITHM}\n{amz_date}\n{scope}\n{hashlib.sha256(canonical_request.encode()).hexdigest()}"
+    signature = hmac.new(signing_key(storage_settings.MINIO_ROOT_PASSWORD, amz_date[:8],
+                                     storage_settings.MINIO_REGION),
+                         string_to_sign.encode(), hashlib.sha256).hexdigest()
+    return f"{endpoint.scheme}://{endpoint.netloc}{path}?{query}&X-Amz-Signature={signature}"
+
+
+def file_urls(file_name: str, thumbnails: list, thumbnails_pending: bool) -> dict:
+    """Download urls of a file and of its thumbnails of the given sizes, in the shape of the media API answer."""
+    return {"msg": "ok", "url": presign(blob_key(file_name)),
+            "thumbnails": {str(size): presign(thumbnail_key(file_name, size)) for size in thumbnails},
+            "thumbnails_pending": thumbnails_pending}
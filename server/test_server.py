@@ -1,11 +1,28 @@
 from server import app
+from model import engine, Meme
+from settings import storage_settings, service_settings
+from media_connector import url_cache, delete_file
+from validators import encode_cursor, encode_search_cursor
+from sniff import sniff_image_type, sniff_content_type, SNIFF_LENGTH
 from fastapi.testclient import TestClient
+from contextlib import contextmanager
+from sqlalchemy import event
+import base64
+import httpx
 import random
+import time
 import pytest
 
 client = TestClient(app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def lifespan():
+    # One event loop for the whole module: the pooled engine and the media client are bound to it.
+    with client:
+        yield
+
+
 @pytest.mark.dependency()
 def test_create_correct():
     images = ['image.jpg', 'image.png']
@@ -38,6 +55,31 @@ def test_create_unsupported_image():
         assert response.json()['detail'][0]['loc'] == ['body', 'file']
 
 
+@pytest.mark.dependency(depends=['test_create_correct'])
+def test_create_spoofed_content_type():
+    with open("test_media/not_image.txt", "rb") as file:
+        response = client.post("/memes?text=text", files={"file": ("image.png", file, "image/png")})
+        assert response.status_code == 415
+        assert response.json()['detail'][0]['loc'] == ['body', 'file']
+
+    with open("test_media/image.jpg", "rb") as file:
+        response = client.post("/memes?text=text", files={"file": ("image.png", file, "image/png")})
+        assert response.status_code == 201
+        assert response.json()['mimetype'] == 'image/jpeg'
+
+
+def test_sniff_animated_png():
+    # pHYs comes before acTL in this APNG, as written by Pillow
+    with open("test_media/animated.png", "rb") as file:
+        assert sniff_image_type(file.read(SNIFF_LENGTH)) == "apng"
+    with open("test_media/image.png", "rb") as file:
+        assert sniff_image_type(file.read(SNIFF_LENGTH)) == "png"
+    with open("test_media/image.webp", "rb") as file:
+        assert sniff_content_type(file.read(SNIFF_LENGTH)) == "image/webp"
+    with open("test_media/image.svg", "rb") as file:
+        assert sniff_content_type(file.read(SNIFF_LENGTH)) == "application/octet-stream"
+
+
 @pytest.mark.dependency(depends=['test_create_correct'])
 def test_create_large_image():
     file_name = "very_large_image.jpg"
@@ -47,6 +89,20 @@ def test_create_large_image():
         assert response.json()['detail'][0]['loc'] == ['body', 'file']
 
 
+@pytest.mark.dependency(depends=['test_create_correct'])
+def test_create_oversized_body():
+    def body():
+        yield (b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="image.jpg"\r\n'
+               b'Content-Type: image/jpeg\r\n\r\n')
+        for _ in range(16):
+            yield b'0' * 1024 * 1024
+
+    response = client.post("/memes?text=text", content=body(),
+                           headers={"content-type": "multipart/form-data; boundary=boundary"})
+    assert response.status_code == 413
+    assert response.json()['detail'][0]['loc'] == ['body', 'file']
+
+
 @pytest.mark.dependency(depends=['test_create_correct'])
 def test_create_no_image():
     response = client.post("/memes?text=text", )
@@ -204,6 +260,7 @@ def test_put_text_correct():
 
     response_body_get = client.get(f"/memes/{meme_id}").json()
     del response_body_get['url']
+    del response_body_get['thumbnails']
 
     assert response_body_get == response_body_put
 
@@ -258,6 +315,15 @@ def test_put_image_incorrect():
     assert response_body_put['detail'][0]['loc'] == ['body', 'file']
 
 
+@pytest.mark.dependency(depends=['test_put_image_incorrect'])
+def test_put_image_not_existed():
+    with open("test_media/not_image.txt", "rb") as file:
+        response = client.put("/memes/999999999", files={"file": ("not_image.txt", file)})
+
+    assert response.status_code == 404
+    assert response.json()['detail'][0]['loc'] == ['path', 'meme_id']
+
+
 @pytest.mark.dependency(depends=['test_put_image_correct'])
 def test_put_image_large():
     file_name = "image.jpg"
@@ -272,3 +338,375 @@ def test_put_image_large():
 
     assert response.status_code == 413
     assert response_body_put['detail'][0]['loc'] == ['body', 'file']
+
+
+@pytest.mark.dependency(depends=['test_create_correct'])
+def test_db_pool_status():
+    response = client.get("/status/db-pool")
+    response_body = response.json()
+
+    assert response.status_code == 200
+    assert "pooled" in response_body
+    if response_body["pooled"]:
+        assert response_body["checked_out"] >= 0
+        assert response_body["idle"] >= 0
+        assert response_body["checkouts"] > 0
+
+
+@pytest.mark.dependency(depends=['test_get_all_correct'])
+def test_get_all_cursor():
+    created = []
+    for image_name in ['image.jpg', 'image.png'] * 2:
+        with open(f"test_media/{image_name}", "rb") as file:
+            created.append(client.post("/memes?text=text", files={"file": (image_name, file)}).json()["meme_id"])
+
+    seen = []
+    response_body = client.get("/memes?cursor=&limit=3").json()
+    while True:
+        seen.extend(meme["meme_id"] for meme in response_body["items"])
+        if response_body["next_cursor"] is None:
+            break
+        response_body = client.get(f"/memes?cursor={response_body['next_cursor']}&limit=3").json()
+
+    assert seen == sorted(seen)
+    assert set(created) <= set(seen)
+
+
+@pytest.mark.dependency(depends=['test_get_all_cursor'])
+def test_get_all_invalid_cursor():
+    for cursor in ["not-a-cursor", "%C3%A9", base64.urlsafe_b64encode("m:²".encode()).decode(),
+                   encode_cursor(99999999999)]:
+        response = client.get(f"/memes?cursor={cursor}")
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['loc'] == ['query', 'cursor']
+
+
+@pytest.mark.dependency(depends=['test_get_correct'])
+def test_url_cache_hit():
+    file_name = "image.jpg"
+    with open(f"test_media/{file_name}", "rb") as file:
+        meme_id = client.post("/memes?text=text", files={"file": (file_name, file)}).json()['meme_id']
+
+    first_url = client.get(f"/memes/{meme_id}").json()['url']
+    hits = client.get("/status/url-cache").json()['hits']
+    second_url = client.get(f"/memes/{meme_id}").json()['url']
+
+    assert first_url == second_url
+    assert client.get("/status/url-cache").json()['hits'] == hits + 1
+
+
+@pytest.mark.dependency(depends=['test_url_cache_hit'])
+def test_thumbnails_after_list():
+    file_name = "image.jpg"
+    with open(f"test_media/{file_name}", "rb") as file:
+        meme_id = client.post("/memes?text=text", files={"file": (file_name, file, "image/jpeg")}).json()['meme_id']
+    for _ in range(50):
+        thumbnails = client.get(f"/memes/{meme_id}").json()['thumbnails']
+        if thumbnails:
+            break
+        time.sleep(0.1)
+    assert thumbnails
+
+    url_cache.clear()
+    page = client.get(f"/memes?cursor={encode_cursor(meme_id - 1)}&limit=1&include_urls=true").json()
+    assert page['items'][0]['meme_id'] == meme_id
+    assert client.get(f"/memes/{meme_id}").json()['thumbnails'].keys() == thumbnails.keys()
+
+
+@pytest.mark.dependency(depends=['test_get_all_cursor'])
+def test_get_all_with_urls():
+    response = client.get("/memes?cursor=&limit=5&include_urls=true")
+    response_body = response.json()
+
+    assert response.status_code == 200
+    assert len(response_body["items"]) > 0
+    for meme in response_body["items"]:
+        assert "url" in meme
+        assert client.get(f"/memes/{meme['meme_id']}").json()["url"] == meme["url"]
+
+
+@pytest.mark.dependency(depends=['test_get_all_with_urls'])
+def test_get_all_with_urls_missing_image():
+    file_name = "image.jpg"
+    meme_ids = []
+    for _ in range(2):
+        with open(f"test_media/{file_name}", "rb") as file:
+            meme_ids.append(client.post("/memes?text=text", files={"file": (file_name, file)}).json()['meme_id'])
+    meme = client.portal.call(Meme.get_meme_by_id, meme_ids[0])
+    assert client.portal.call(delete_file, meme.new_file_name)
+
+    response = client.get(f"/memes?cursor={encode_cursor(meme_ids[0] - 1)}&limit=2&include_urls=true")
+    items = response.json()['items']
+
+    assert response.status_code == 200
+    assert [item['meme_id'] for item in items] == meme_ids
+    assert items[0]['url'] is None
+    assert items[1]['url'] is not None
+
+
+@pytest.mark.dependency(depends=['test_create_correct', 'test_create_not_image'])
+def test_create_batch():
+    file_names = ['image.jpg', 'not_image.txt', 'image.png']
+    files = [("files", (file_name, open(f"test_media/{file_name}", "rb"))) for file_name in file_names]
+    response = client.post("/memes/batch", files=files, data={"texts": ["first", "second", "third"]})
+    response_body = response.json()
+
+    assert response.status_code == 200
+    assert response_body['created'] == 2
+    assert response_body['failed'] == 1
+    assert [item['status_code'] for item in response_body['items']] == [201, 415, 201]
+    assert response_body['items'][0]['meme']['text'] == 'first'
+    assert response_body['items'][1]['detail'][0]['loc'] == ['body', 'file']
+    assert response_body['items'][2]['meme']['file_name'] == 'image.png'
+    assert response_body['items'][0]['meme']['meme_id'] < response_body['items'][2]['meme']['meme_id']
+
+
+@pytest.mark.dependency(depends=['test_create_batch'])
+def test_create_batch_texts_mismatch():
+    file_name = "image.jpg"
+    with open(f"test_media/{file_name}", "rb") as file:
+        response = client.post("/memes/batch", files=[("files", (file_name, file))], data={"texts": ["a", "b"]})
+
+    assert response.status_code == 422
+    assert response.json()['detail'][0]['loc'] == ['body', 'texts']
+
+
+@pytest.mark.dependency(depends=['test_delete_correct', 'test_create_batch'])
+def test_delete_many():
+    file_name = "image.jpg"
+    meme_ids = []
+    for _ in range(3):
+        with open(f"test_media/{file_name}", "rb") as file:
+            meme_ids.append(client.post("/memes?text=text", files={"file": (file_name, file)}).json()['meme_id'])
+
+    response = client.request("DELETE", "/memes", json={"meme_ids": meme_ids + [100000]})
+    response_body = response.json()
+
+    assert response.status_code == 200
+    assert sorted(meme['meme_id'] for meme in response_body['deleted']) == meme_ids
+    assert response_body['not_found'] == [100000]
+    for meme_id in meme_ids:
+        assert client.get(f"/memes/{meme_id}").status_code == 404
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.mark.dependency(depends=['test_put_text_correct', 'test_put_image_correct', 'test_delete_correct'])
+def test_query_count():
+    file_name = "image.jpg"
+    with open(f"test_media/{file_name}", "rb") as file:
+        meme_id = client.post("/memes?text=text", files={"file": (file_name, file)}).json()['meme_id']
+
+    with count_queries() as statements:
+        assert client.put(f"/memes/{meme_id}?text=another").status_code == 200
+    assert len(statements) == 1
+
+    with count_queries() as statements, open(f"test_media/{file_name}", "rb") as file:
+        assert client.put(f"/memes/{meme_id}", files={"file": (file_name, file)}).status_code == 200
+    # the existence check before the upload is served by the meme cache, or is one SELECT
+    assert len([statement for statement in statements if not statement.startswith("SELECT")]) == 1
+    assert len(statements) <= 2
+
+    with count_queries() as statements:
+        assert client.delete(f"/memes/{meme_id}").status_code == 200
+    assert len(statements) == 1
+
+    with count_queries() as statements:
+        assert client.delete(f"/memes/{meme_id}").status_code == 404
+        assert client.put(f"/memes/{meme_id}?text=another").status_code == 404
+    assert len(statements) == 2
+
+
+@pytest.mark.dependency(depends=['test_create_correct'])
+def test_search():
+    word = f"searchable{random.randint(0, 10 ** 9)}"
+    file_name = "image.jpg"
+    meme_ids = []
+    for text in [f"{word}", f"{word} {word} cat", "cat"]:
+        with open(f"test_media/{file_name}", "rb") as file:
+            meme_ids.append(client.post(f"/memes?text={text}", files={"file": (file_name, file)}).json()['meme_id'])
+
+    response = client.get(f"/memes/search?q={word}&limit=1")
+    response_body = response.json()
+    assert response.status_code == 200
+    assert response_body['items'][0]['meme_id'] == meme_ids[1]
+
+    response_body = client.get(f"/memes/search?q={word}&limit=1&cursor={response_body['next_cursor']}").json()
+    assert response_body['items'][0]['meme_id'] == meme_ids[0]
+    assert response_body['next_cursor'] is None
+
+
+@pytest.mark.dependency(depends=['test_search'])
+def test_search_invalid_cursor():
+    for cursor in ["%C3%A9", encode_search_cursor(float("nan"), 1), encode_search_cursor(float("inf"), 1),
+                   encode_search_cursor(0.5, 99999999999), encode_cursor(1)]:
+        response = client.get(f"/memes/search?q=text&cursor={cursor}")
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['loc'] == ['query', 'cursor']
+
+
+@pytest.mark.dependency(depends=['test_search'])
+def test_search_empty_query():
+    response = client.get("/memes/search?q=")
+    assert response.status_code == 422
+    assert response.json()['detail'][0]['loc'] == ['query', 'q']
+
+
+@pytest.mark.dependency(depends=['test_delete_correct'])
+def test_delete_queues_storage_removal():
+    file_name = "image.jpg"
+    with open(f"test_media/{file_name}", "rb") as file:
+        meme_id = client.post("/memes?text=text", files={"file": (file_name, file)}).json()['meme_id']
+
+    pending = client.get("/status/outbox").json()['pending']
+    assert client.delete(f"/memes/{meme_id}").status_code == 200
+    assert client.get("/status/outbox").json()['pending'] == pending + 1
+
+
+@pytest.mark.dependency(depends=['test_get_correct', 'test_put_text_correct'])
+def test_etag_not_modified():
+    file_name = "image.jpg"
+    with open(f"test_media/{file_name}", "rb") as file:
+        meme_id = client.post("/memes?text=text", files={"file": (file_name, file)}).json()['meme_id']
+
+    for path in [f"/memes/{meme_id}", "/memes"]:
+        etag = client.get(path).headers['etag']
+        response = client.get(path, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers['etag'] == etag
+        assert etag.startswith('W/"')
+
+    etag = client.get("/memes").headers['etag']
+    assert client.get(f"/memes/{meme_id}", headers={"If-None-Match": etag}).status_code == 200
+    assert client.get("/memes/999999999", headers={"If-None-Match": etag}).status_code == 404
+
+    etag = client.get(f"/memes/{meme_id}").headers['etag']
+    assert client.put(f"/memes/{meme_id}?text=another").status_code == 200
+    response = client.get(f"/memes/{meme_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+
+    # the same text again changes nothing
+    etag = response.headers['etag']
+    assert client.put(f"/memes/{meme_id}?text=another").json()['text'] == "another"
+    assert client.get(f"/memes/{meme_id}", headers={"If-None-Match": etag}).status_code == 304
+
+
+def meme_cache_status():
+    response = client.get("/status/meme-cache")
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.mark.dependency(depends=['test_get_correct', 'test_put_text_correct', 'test_delete_correct'])
+def test_meme_cache_status():
+    for _ in range(50):
+        if meme_cache_status()['listening']:
+            break
+        time.sleep(0.1)
+    assert meme_cache_status()['listening']
+
+    file_name = "image.jpg"
+    with open(f"test_media/{file_name}", "rb") as file:
+        meme_id = client.post("/memes?text=text", files={"file": (file_name, file)}).json()['meme_id']
+
+    assert client.get(f"/memes/{meme_id}").status_code == 200
+    hits = meme_cache_status()['hits']
+    assert client.get(f"/memes/{meme_id}").json()['text'] == "text"
+    assert meme_cache_status()['hits'] == hits + 1
+
+    missing_id = meme_id + 10 ** 6
+    assert client.get(f"/memes/{missing_id}").status_code == 404
+    hits = meme_cache_status()['hits']
+    assert client.get(f"/memes/{missing_id}").status_code == 404
+    assert meme_cache_status()['hits'] == hits + 1
+
+    assert client.put(f"/memes/{meme_id}?text=changed").status_code == 200
+    hits = meme_cache_status()['hits']
+    assert client.get(f"/memes/{meme_id}").json()['text'] == "changed"
+    assert meme_cache_status()['hits'] == hits
+
+    assert client.delete(f"/memes/{meme_id}").status_code == 200
+    assert client.get(f"/memes/{meme_id}").status_code == 404
+
+    status = meme_cache_status()
+    assert status['size'] <= status['maxsize']
+    assert 0.0 < status['hit_ratio'] <= 1.0
+
+
+@pytest.mark.dependency(depends=['test_get_correct'])
+def test_metrics():
+    client.get("/memes")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/memes",status="200"}' in response.text
+    assert 'db_query_duration_seconds_count{statement="SELECT"}' in response.text
+
+
+@pytest.mark.dependency(depends=['test_create_correct'])
+def test_direct_upload():
+    response = client.post("/memes/uploads?text=direct&file_name=image.jpg&content_type=image/jpeg")
+    ticket = response.json()
+    assert response.status_code == 201
+    assert ticket['fields']
+
+    assert client.post(f"/memes/uploads/{ticket['upload_id']}/confirm").status_code == 409
+
+    # the url is the public endpoint of the storage, from here it is reached by its service name
+    url = ticket['url'].replace("localhost", "storage", 1)
+    with open("test_media/image.jpg", "rb") as file:
+        assert httpx.post(url, data=ticket['fields'], files={"file": ("image.jpg", file, "image/jpeg")}).is_success
+
+    response = client.post(f"/memes/uploads/{ticket['upload_id']}/confirm")
+    assert response.status_code == 201
+    assert response.json()['text'] == 'direct'
+    assert response.json()['mimetype'] == 'image/jpeg'
+    assert client.get(f"/memes/{response.json()['meme_id']}").status_code == 200
+    assert client.post(f"/memes/uploads/{ticket['upload_id']}/confirm").status_code == 404
+
+
+@pytest.mark.dependency(depends=['test_create_correct'])
+def test_direct_upload_not_image():
+    response = client.post("/memes/uploads?text=direct&file_name=image.svg&content_type=image/svg%2Bxml")
+    assert response.status_code == 415
+    assert response.json()['detail'][0]['loc'] == ['body', 'file']
+
+
+@pytest.mark.dependency(depends=['test_get_correct'])
+def test_get_public_url():
+    file_name = "image.jpg"
+    with open(f"test_media/{file_name}", "rb") as file:
+        meme_id = client.post("/memes?text=text", files={"file": (file_name, file)}).json()['meme_id']
+
+    url = client.get(f"/memes/{meme_id}").json()['url']
+    assert url.startswith(f"{storage_settings.MINIO_PUBLIC_URL}/{storage_settings.MINIO_BUCKET_NAME}/")
+    assert "X-Amz-Signature=" in url
+    assert client.get(f"/memes/{meme_id}").json()['url'] == url
+
+
+@pytest.mark.dependency(depends=['test_get_all_with_urls'])
+def test_fast_responses():
+    paths = ["/memes?limit=5", "/memes?cursor=&limit=5&include_urls=true", "/memes/search?q=text"]
+    expected = [client.get(path).json() for path in paths]
+    service_settings.FAST_RESPONSES = 1
+    try:
+        responses = [client.get(path) for path in paths]
+    finally:
+        service_settings.FAST_RESPONSES = 0
+
+    assert [response.json() for response in responses] == expected
+    assert "ETag" in responses[0].headers
@@ -1,38 +1,76 @@
-from fastapi import Depends, HTTPException, UploadFile
+import base64
+import binascii
+import hashlib
+import math
+import re
+import time
+
+from fastapi import Depends, HTTPException, UploadFile, Query, Header, Request, Response
+from pydantic import BaseModel, Field, PositiveInt
 from typing import Annotated
 from model import Meme
 
-from responses import MemeNotFound, InvalidMediaFile
-from settings import service_settings
+from responses import MemeNotFound, InvalidMediaFile, InvalidCursor
+from settings import service_settings, media_settings
+from sniff import sniff_image_type, SNIFF_LENGTH
 
 
-def file_size_validation(file: UploadFile) -> UploadFile:
-    if file.size > service_settings.MAX_IMAGE_SIZE:
+ALLOWED_IMAGE_TYPES = frozenset(image_type.strip() for image_type in service_settings.ALLOWED_IMAGE_TYPES.split(","))
+
+
+def image_size_validation(size: int):
+    if size > service_settings.MAX_IMAGE_SIZE:
         raise HTTPException(status_code=413,
                             detail=InvalidMediaFile(msg=f"The file size should not "
-                                                        f"exceed {service_settings.MAX_IMAGE_SIZE}KB",
-                                                    input=file.size // 1024).details())
-    return file
+                                                        f"exceed {service_settings.MAX_IMAGE_SIZE // 1024}KB",
+                                                    input=size // 1024).details())
 
 
-def file_type_validation(file: UploadFile) -> UploadFile:
-    if not file.content_type:
-        raise HTTPException(status_code=415,
-                            detail=InvalidMediaFile(msg="You should provide content type of file.",
-                                                    input=file.content_type).details())
+def file_size_validation(file: UploadFile) -> UploadFile:
+    image_size_validation(file.size)
+    return file
+
 
-    if not file.content_type.startswith("image/"):
+def image_type_validation(image_type: str | None, declared: str) -> str:
+    """Mimetype of an allowed image type. 415 for anything else, declared is the type reported back."""
+    if image_type is None:
         raise HTTPException(status_code=415,
                             detail=InvalidMediaFile(msg="You can only attach a picture to a meme",
-                                                    input=file.content_type).details())
+                                                    input=declared).details())
 
-    if not file.content_type[6:] in service_settings.ALLOWED_IMAGE_TYPES:
+    if image_type not in ALLOWED_IMAGE_TYPES:
         raise HTTPException(status_code=415,
                             detail=InvalidMediaFile(msg="This image format is not supported",
-                                                    input=file.content_type).details())
+                                                    input=f"image/{image_type}").details())
+
+    return "image/png" if image_type == "apng" else f"image/{image_type}"
+
+
+def content_image_type(content_type: str) -> str | None:
+    return content_type.removeprefix("image/") if content_type.startswith("image/") else None
+
+
+def file_type_validation(file: UploadFile) -> UploadFile:
+    """Trusts the first bytes of the file, not the content type sent by the client.
+    The content type of the file is replaced with the detected one."""
+    head = file.file.read(SNIFF_LENGTH)
+    file.file.seek(0)
+
+    mimetype = image_type_validation(sniff_image_type(head), file.content_type or "")
+
+    headers = file.headers.mutablecopy()
+    headers["content-type"] = mimetype
+    file.headers = headers
     return file
 
 
+def uploaded_image_validation(uploaded: dict) -> str:
+    """Checks an image uploaded straight to the storage like an uploaded file, by the size and the sniffed
+    content type reported by the media service. Returns its mimetype."""
+    image_size_validation(uploaded["size"])
+    return image_type_validation(content_image_type(uploaded["content_type"]), uploaded["content_type"])
+
+
 def image_validation_func(file: UploadFile):
     return file_type_validation(
         file_size_validation(
@@ -59,7 +97,7 @@ image_validator = Annotated[UploadFile, Depends(ImageContentValidator(), use_cac
 
 class MemeExists:
     async def __call__(self, meme_id: int) -> Meme:
-        meme = await Meme.get_meme_by_id(meme_id)
+        meme = await Meme.get_cached_by_id(meme_id)
         if meme is None:
             raise HTTPException(status_code=404, detail=MemeNotFound(meme_id).details())
 
@@ -67,3 +105,124 @@ class MemeExists:
 
 
 valid_meme = Depends(MemeExists())
+
+
+class ValidUploadType:
+    """The storage only accepts the content type declared when the upload is reserved, so only images may be
+    declared. What was really uploaded is checked again when the upload is confirmed."""
+    async def __call__(self, content_type: str = Query(max_length=64,
+                                                       description="Content type of the image, e.g. image/png.")
+                       ) -> str:
+        image_type_validation(content_image_type(content_type), content_type)
+        return content_type
+
+
+valid_upload_type = Depends(ValidUploadType())
+
+# Responses carry presigned urls, which may be cached for up to half of their lifetime before they are sent.
+# Starting a new ETag every quarter of the lifetime keeps revalidated clients from holding expired urls.
+ETAG_URL_PERIOD = media_settings.MEDIA_PRESIGNED_URL_EXPIRED_HOURS * 60 * 60 // 4
+
+
+def make_etag(version: int, request: Request) -> str:
+    """Weak ETag: bodies with the same tag carry equivalent memes, though their presigned urls may differ.
+    The path and query are part of the tag, so a tag of one resource never matches another."""
+    resource = hashlib.blake2b(f"{request.url.path}?{request.url.query}".encode(), digest_size=6).hexdigest()
+    return f'W/"{version}.{int(time.time()) // ETAG_URL_PERIOD}.{resource}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in if_none_match.split(","))
+
+
+class FreshETag:
+    """ETag of the memes table computed from its change version, without building the body.
+    Answers 304 Not Modified when the client already has it, before the meme or media service are queried.
+    Routes put it after the dependencies which answer 404, a missing meme never gets 304."""
+    async def __call__(self, request: Request, response: Response,
+                       if_none_match: str | None = Header(None, description="ETag of the copy the client has.")) -> str:
+        etag = make_etag(await Meme.get_version(), request)
+        if if_none_match is not None and etag_matches(if_none_match, etag):
+            raise HTTPException(status_code=304, headers={"ETag": etag})
+
+        response.headers["ETag"] = etag
+        return etag
+
+
+fresh_etag = Depends(FreshETag())
+
+
+MAX_MEME_ID = 2 ** 31 - 1  # meme_id is an int4 column
+
+
+def encode_cursor(meme_id: int) -> str:
+    return base64.urlsafe_b64encode(f"m:{meme_id}".encode()).decode().rstrip("=")
+
+
+def encode_search_cursor(rank: float, meme_id: int) -> str:
+    return base64.urlsafe_b64encode(f"s:{rank!r}:{meme_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, prefix: str) -> list[str]:
+    try:
+        parts = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        if parts[0] == prefix:
+            return parts[1:]
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        pass
+    raise HTTPException(status_code=422, detail=InvalidCursor(cursor).details())
+
+
+def cursor_meme_id(value: str) -> int | None:
+    """meme_id of a cursor, None unless it is plain ASCII digits within the range of the int4 column."""
+    if re.fullmatch(r"[0-9]+", value) and int(value) <= MAX_MEME_ID:
+        return int(value)
+    return None
+
+
+class ValidCursor:
+    """Decodes the cursor of GET /memes into the last seen meme_id.
+    An empty cursor starts from the first page, no cursor means offset pagination."""
+    async def __call__(self, cursor: str = Query(None, max_length=64,
+                                                 title="Cursor of the page. Pass an empty value to get the first one",
+                                                 description="Switches the list to keyset pagination.")) -> int | None:
+        if cursor is None:
+            return None
+        if cursor == "":
+            return 0
+        parts = decode_cursor(cursor, "m")
+        meme_id = cursor_meme_id(parts[0]) if len(parts) == 1 else None
+        if meme_id is None:
+            raise HTTPException(status_code=422, detail=InvalidCursor(cursor).details())
+        return meme_id
+
+
+valid_cursor = Depends(ValidCursor())
+
+
+class ValidSearchCursor:
+    """Decodes the cursor of GET /memes/search into the (rank, meme_id) of the last seen meme."""
+    async def __call__(self, cursor: str = Query(None, max_length=128,
+                                                 title="Cursor of the page. Omit it to get the first one")
+                       ) -> tuple[float, int] | None:
+        if not cursor:
+            return None
+        try:
+            rank, meme_id = decode_cursor(cursor, "s")
+            rank, meme_id = float(rank), cursor_meme_id(meme_id)
+        except ValueError:
+            rank, meme_id = None, None
+        # nan and inf would break the keyset comparison with ts_rank
+        if meme_id is None or not math.isfinite(rank):
+            raise HTTPException(status_code=422, detail=InvalidCursor(cursor).details())
+        return rank, meme_id
+
+
+valid_search_cursor = Depends(ValidSearchCursor())
+
+
+class MemeIds(BaseModel):
+    meme_ids: list[PositiveInt] = Field(min_length=1, max_length=service_settings.MEMES_DELETE_BATCH_MAX_SIZE,
+                                        description="IDs of the memes.")